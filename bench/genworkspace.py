@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""Generate a synthetic C workspace to benchmark preprocess.py on.
+
+The workspace is made of layers of headers: each .c file #include's
+"fanout" headers of the first layer, each of which #include's "fanout"
+headers of the next one, "depth" layers deep. Headers have include
+guards. All files have random text lines, #define/#undef's and #if
+blocks nested up to "ifDepth" deep, whose conditions use the "macros"
+macros. The same parameters and seed always give the same workspace.
+"""
+
+import os
+import sys
+import random
+import optparse
+
+
+defaultParams = {
+    "files": 200,           # number of .c files
+    "headers": 50,          # number of headers per layer
+    "depth": 3,             # number of layers of headers
+    "fanout": 4,            # #include's per file
+    "ifDepth": 3,           # maximum nesting of #if blocks
+    "macros": 100,          # number of distinct macro names
+    "directiveRatio": 0.2,  # proportion of directive lines
+    "lines": 100,           # lines per file (excluding #include's)
+    "seed": 0,
+}
+
+
+class _Generator(object):
+    def __init__(self, params):
+        self.params = params
+        self.random = random.Random(params["seed"])
+
+    def _macro(self):
+        return "M%d" % self.random.randrange(self.params["macros"])
+
+    def _condition(self):
+        r = self.random
+        kind = r.randrange(5)
+        if kind == 0:
+            return "defined(%s)" % self._macro()
+        elif kind == 1:
+            return "!defined(%s) && %s > %d" % (self._macro(), self._macro(),
+                                                r.randrange(10))
+        elif kind == 2:
+            return "%s == %d || defined %s" % (self._macro(), r.randrange(4),
+                                               self._macro())
+        elif kind == 3:
+            return "(%s + %s) * 2 >= %d" % (self._macro(), self._macro(),
+                                            r.randrange(20))
+        return "0"
+
+    def _text(self):
+        r = self.random
+        kind = r.randrange(4)
+        if kind == 0:
+            return "int v%d = %s + %du;" % (r.randrange(1000), self._macro(),
+                                            r.randrange(100))
+        elif kind == 1:
+            return "    call_%d(%s, \"%s\"); /* %s */" % (
+                r.randrange(100), self._macro(), self._macro(), self._macro())
+        elif kind == 2:
+            return ""
+        return "static const char *s%d = \"line __LINE__\";" % r.randrange(100)
+
+    def _body(self, lines, numLines, depth=0):
+        r = self.random
+        ratio = self.params["directiveRatio"]
+        while numLines > 0:
+            if r.random() >= ratio:
+                lines.append(self._text())
+                numLines -= 1
+                continue
+            kind = r.randrange(4)
+            if kind == 0:
+                lines.append("#define %s %d" % (self._macro(),
+                                                r.randrange(10)))
+                numLines -= 1
+            elif kind == 1:
+                lines.append("#undef %s" % self._macro())
+                numLines -= 1
+            elif depth >= self.params["ifDepth"] or numLines < 4:
+                lines.append("#define %s" % self._macro())
+                numLines -= 1
+            else:
+                # An #if block with 1 to 3 branches, each its own body.
+                branches = r.randrange(1, 4)
+                size = min(numLines, r.randrange(4, 20))
+                numLines -= size
+                size -= branches + 1    # the directive lines
+                lines.append("#if %s" % self._condition())
+                for i in range(branches):
+                    if i == branches - 1 and i:
+                        lines.append("#else")
+                    elif i:
+                        lines.append("#elif %s" % self._condition())
+                    self._body(lines, max(size // branches, 1), depth + 1)
+                lines.append("#endif")
+
+    def _file(self, includes, guard=None):
+        lines = []
+        if guard:
+            lines += ["#ifndef %s" % guard, "#define %s" % guard]
+        for include in includes:
+            lines.append('#include "%s"' % include)
+        self._body(lines, self.params["lines"])
+        if guard:
+            lines.append("#endif")
+        return "\n".join(lines) + "\n"
+
+    def generate(self, workspace):
+        p, r = self.params, self.random
+        files = {}
+        layers = [["h%d_%d.h" % (layer, i) for i in range(p["headers"])]
+                  for layer in range(p["depth"])]
+        for layer, names in enumerate(layers):
+            nextLayer = []
+            if layer + 1 < len(layers):
+                nextLayer = layers[layer + 1]
+            for i, name in enumerate(names):
+                includes = r.sample(nextLayer, min(p["fanout"],
+                                                   len(nextLayer)))
+                path = os.path.join("include", "layer%d" % layer, name)
+                files[path] = self._file(includes, "%s_H" % name[:-2].upper())
+        firstLayer = []
+        if layers:
+            firstLayer = layers[0]
+        for i in range(p["files"]):
+            includes = r.sample(firstLayer, min(p["fanout"], len(firstLayer)))
+            path = os.path.join("src", "mod%d" % (i % 10), "f%d.c" % i)
+            files[path] = self._file(includes)
+        for path, content in sorted(files.items()):
+            path = os.path.join(workspace, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fout = open(path, 'w')
+            try:
+                fout.write(content)
+            finally:
+                fout.close()
+        return sorted(files)
+
+
+def generate(workspace, **params):
+    """Generate a synthetic workspace in 'workspace' (see defaultParams
+    for the parameters) and return the relative paths of its files.
+    """
+    unknown = set(params) - set(defaultParams)
+    if unknown:
+        raise TypeError("unknown parameter(s): %s" % ", ".join(sorted(unknown)))
+    allParams = dict(defaultParams)
+    allParams.update(params)
+    return _Generator(allParams).generate(workspace)
+
+
+def main(argv):
+    parser = optparse.OptionParser(prog="genworkspace",
+        usage="%prog [options] WORKSPACE",
+        description="Generate a synthetic C workspace in WORKSPACE.")
+    for name, default in sorted(defaultParams.items()):
+        parser.add_option("--" + name, type=type(default).__name__,
+                          default=default,
+                          help="(default: %s)" % default)
+    opts, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error("incorrect number of arguments")
+    params = dict((name, getattr(opts, name)) for name in defaultParams)
+    paths = generate(args[0], **params)
+    sys.stdout.write("%d files written to %s\n" % (len(paths), args[0]))
+
+
+if __name__ == "__main__":
+    sys.exit( main(sys.argv) )
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+"""Benchmark preprocess.py on synthetic workspaces (see genworkspace.py).
+
+Measures:
+- endToEnd: a `preprocess` run (as main() does it, in a new process)
+  over the whole workspace, from scratch and then with all outputs up
+  to date;
+- include: the cost of an #include, the first time a header is read
+  and once it is cached, and of an #include skipped by its guard;
+- evaluate: _evaluate() on the workspace's #if/#elif expressions;
+- substitute: the extra cost of "substitute" per output line.
+
+Results are written as JSON; `--compare` shows how they changed from
+an earlier results file, e.g. made with another version of preprocess.py
+(see `--lib`).
+"""
+
+import os
+import io
+import re
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import optparse
+import subprocess
+
+import genworkspace
+
+
+_benchDir = os.path.dirname(os.path.abspath(__file__))
+_defaultLib = os.path.join(os.path.dirname(_benchDir), "lib")
+
+
+def _importPreprocess(lib):
+    sys.path.insert(0, lib)
+    try:
+        import preprocess
+    finally:
+        del sys.path[0]
+    return preprocess
+
+
+def _revision(lib):
+    try:
+        rev = subprocess.check_output(["git", "describe", "--always",
+                                       "--dirty"], cwd=lib,
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return rev.decode("ascii").strip()
+
+
+def _best(func, repeat):
+    """Return the shortest time in seconds of 'repeat' calls of 'func'."""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _sourceFiles(workspace, suffix):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(workspace):
+        dirnames.sort()
+        paths += [os.path.join(dirpath, f) for f in sorted(filenames)
+                  if f.endswith(suffix)]
+    return paths
+
+
+# Versions of preprocess.py before preprocessWorkspace() had a main()
+# without arguments, that did this on a hardcoded workspace.
+_endToEndScript = """\
+import os, sys
+sys.path.insert(0, %(lib)r)
+import preprocess
+workspace, outdir = %(workspace)r, %(outdir)r
+if hasattr(preprocess, "preprocessWorkspace"):
+    sys.exit(preprocess.main(["preprocess", "-o", outdir, workspace]))
+for r, d, f in os.walk(workspace):
+    for file in f:
+        if file[-2:] in [".c", ".h"]:
+            outfile = os.path.join(outdir, r[len(workspace)+1:], file)
+            if not os.path.isdir(os.path.dirname(outfile)):
+                os.makedirs(os.path.dirname(outfile))
+            preprocess.preprocess(workspace, os.path.join(r, file), outfile,
+                                  {}, 1)
+"""
+
+def benchEndToEnd(lib, workspace, tmpdir, repeat):
+    outdir = os.path.join(tmpdir, "output")
+    script = _endToEndScript % {"lib": lib, "outdir": outdir,
+                                "workspace": workspace}
+    def run():
+        subprocess.check_call([sys.executable, "-c", script])
+    def fromScratch():
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        run()
+    files = _sourceFiles(workspace, ".c") + _sourceFiles(workspace, ".h")
+    numLines = 0
+    for path in files:
+        fin = open(path)
+        try:
+            numLines += sum(1 for line in fin)
+        finally:
+            fin.close()
+    seconds = _best(fromScratch, repeat)
+    return {"seconds": seconds, "upToDateSeconds": _best(run, repeat),
+            "files": len(files), "filesPerSecond": len(files) / seconds,
+            "linesPerSecond": numLines / seconds}
+
+
+def benchInclude(preprocess, tmpdir, repeat, count=500):
+    workspace = os.path.join(tmpdir, "include")
+    os.makedirs(workspace)
+    for i in range(count):
+        fout = open(os.path.join(workspace, "h%d.h" % i), 'w')
+        fout.write("#ifndef H%d_H\n#define H%d_H\nint h%d;\n#endif\n"
+                   % (i, i, i))
+        fout.close()
+    includes = "".join('#include "h%d.h"\n' % i for i in range(count))
+    for name, content in [("once.c", includes), ("twice.c", includes * 2)]:
+        fout = open(os.path.join(workspace, name), 'w')
+        fout.write(content)
+        fout.close()
+    def run(name):
+        preprocess.preprocess(workspace, os.path.join(workspace, name),
+                              io.StringIO(), {})
+    start = time.perf_counter()
+    run("once.c")
+    cold = time.perf_counter() - start
+    once = _best(lambda: run("once.c"), repeat)
+    twice = _best(lambda: run("twice.c"), repeat)
+    return {"coldMicroseconds": cold / count * 1e6,
+            "cachedMicroseconds": once / count * 1e6,
+            "guardedMicroseconds": max(twice - once, 0) / count * 1e6}
+
+
+def benchEvaluate(preprocess, workspace, repeat, passes=20):
+    exprRe = re.compile(r"^\s*#\s*(?:if|elif)\s+(.*)$", re.M)
+    exprs = []
+    for path in _sourceFiles(workspace, ".c") + _sourceFiles(workspace, ".h"):
+        fin = open(path)
+        try:
+            exprs += exprRe.findall(fin.read())
+        finally:
+            fin.close()
+    # Half the macros are defined, to values that keep every expression
+    # valid (see genworkspace.py).
+    defines = dict(("M%d" % i, i % 5) for i in range(0, 1000, 2))
+    evaluate = preprocess._evaluate
+    def run():
+        for i in range(passes):
+            for expr in exprs:
+                evaluate(expr, defines)
+    seconds = _best(run, repeat)
+    return {"expressions": len(exprs),
+            "distinctExpressions": len(set(exprs)),
+            "nanosecondsPerCall": seconds / (passes * len(exprs)) * 1e9}
+
+
+def benchSubstitute(preprocess, workspace, repeat):
+    files = _sourceFiles(workspace, ".c")
+    counter = {"lines": 0}
+    def run(substitute):
+        lines = 0
+        for path in files:
+            fout = io.StringIO()
+            preprocess.preprocess(workspace, path, fout, {},
+                                  substitute=substitute)
+            lines += fout.getvalue().count("\n")
+        counter["lines"] = lines
+    run(0)     # parse and cache everything first
+    plain = _best(lambda: run(0), repeat)
+    substituted = _best(lambda: run(1), repeat)
+    return {"seconds": plain, "substituteSeconds": substituted,
+            "microsecondsPerLine": max(substituted - plain, 0)
+                                   / max(counter["lines"], 1) * 1e6}
+
+
+def runBenchmarks(lib, params, repeat=3):
+    """Run the benchmarks with the preprocess.py in 'lib' on a workspace
+    generated with 'params' and return the results.
+    """
+    preprocess = _importPreprocess(lib)
+    tmpdir = tempfile.mkdtemp(prefix="preprocess-bench-")
+    try:
+        workspace = os.path.join(tmpdir, "workspace")
+        genworkspace.generate(workspace, **params)
+        benchmarks = [
+            ("endToEnd", benchEndToEnd, (lib, workspace, tmpdir, repeat)),
+            ("include", benchInclude, (preprocess, tmpdir, repeat)),
+            ("evaluate", benchEvaluate, (preprocess, workspace, repeat)),
+            ("substitute", benchSubstitute, (preprocess, workspace, repeat)),
+        ]
+        results = {}
+        for name, bench, args in benchmarks:
+            # Older versions may not cope with some input (some even
+            # sys.exit() on it): record that and go on.
+            try:
+                results[name] = bench(*args)
+            except (Exception, SystemExit) as ex:
+                results[name] = {"error": "%s: %s" % (ex.__class__.__name__,
+                                                      ex)}
+    finally:
+        shutil.rmtree(tmpdir)
+    allParams = dict(genworkspace.defaultParams)
+    allParams.update(params)
+    return {"lib": lib, "revision": _revision(lib),
+            "python": platform.python_version(),
+            "platform": platform.platform(), "time": time.time(),
+            "params": allParams, "repeat": repeat, "results": results}
+
+
+def _format(value):
+    if isinstance(value, (int, float)):
+        return "%.4g" % value
+    return "-"
+
+
+def compare(base, new, fout=sys.stdout):
+    """Write how the "results" of 'new' changed from those of 'base'."""
+    fout.write("%-40s %12s %12s %8s\n" % ("", "base", "new", "new/base"))
+    for bench in sorted(new["results"]):
+        for metric, value in sorted(new["results"][bench].items()):
+            baseValue = base["results"].get(bench, {}).get(metric)
+            ratio = "-"
+            if isinstance(value, (int, float)) and baseValue \
+               and isinstance(baseValue, (int, float)):
+                ratio = "%.2f" % (value / baseValue)
+            fout.write("%-40s %12s %12s %8s\n" % (
+                "%s.%s" % (bench, metric), _format(baseValue),
+                _format(value), ratio))
+
+
+def main(argv):
+    parser = optparse.OptionParser(prog="run",
+        usage="%prog [options]",
+        description="Run the preprocess.py benchmarks and write the "
+                    "results as JSON.")
+    parser.add_option("--lib", default=_defaultLib,
+        help="directory of the preprocess.py to benchmark (default: %s)"
+             % _defaultLib)
+    parser.add_option("-o", "--output", metavar="PATH",
+        help="where to write the results (default: stdout)")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+        help="number of runs of each benchmark, the best one is kept "
+             "(default: 3)")
+    parser.add_option("-p", "--param", action="append", default=[],
+        metavar="NAME=VALUE",
+        help="a workspace parameter, see genworkspace.py")
+    parser.add_option("--compare", metavar="PATH",
+        help="also compare the results with those of an earlier run")
+    opts, args = parser.parse_args(argv[1:])
+    if args:
+        parser.error("too many arguments")
+    params = {}
+    for param in opts.param:
+        name, _, value = param.partition("=")
+        if name not in genworkspace.defaultParams:
+            parser.error("unknown workspace parameter: %r" % name)
+        params[name] = type(genworkspace.defaultParams[name])(value)
+
+    results = runBenchmarks(os.path.abspath(opts.lib), params, opts.repeat)
+    if opts.output:
+        fout = open(opts.output, 'w')
+        try:
+            json.dump(results, fout, indent=2, sort_keys=True)
+        finally:
+            fout.close()
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    if opts.compare:
+        fin = open(opts.compare)
+        try:
+            base = json.load(fin)
+        finally:
+            fin.close()
+        compare(base, results, opts.output and sys.stdout or sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit( main(sys.argv) )
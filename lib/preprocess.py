@@ -6,7 +6,8 @@
 # Options are removed.
 # The output is for call tree analysis, not to be built.
 # How to use:
-#  Set the variable workplace, and run this file.
+#  Set the variable _defaultWorkspace (or give the workspace on the command
+#  line), and run this file. Run with --help for the options.
 
 from builtins import str
 from builtins import range
@@ -14,6 +15,19 @@ from builtins import range
 import os
 import sys
 import re
+import time
+import zlib
+import pickle
+import io
+import json
+import shutil
+import hashlib
+import mmap
+import bisect
+import contextlib
+from collections.abc import MutableMapping
+
+_defaultWorkspace = r"D:\master" #Local directory to define as target input.
 
 class PreprocessError(Exception):
     def __init__(self, errmsg, file=None, lineno=None, line=None):
@@ -36,114 +50,1575 @@ class PreprocessError(Exception):
         return s
 
 #---- internal support stuff
-# This function is especially modified to eval directly C language.
+# #if/#elif expressions are C constant expressions, see _CExpression.
+
+_exprTokenRe = re.compile(r"""
+      (?P<space>\s+|/\*.*?\*/|//.*)
+    | (?P<num>(?:0[xX][0-9a-fA-F]+|[0-9]+)[uUlL]*)
+    | (?P<char>L?'(?:\\.|[^\\'])+')
+    | (?P<name>[a-zA-Z_]\w*)
+    | (?P<op>\|\||&&|==|!=|<=|>=|<<|>>|[-+*/%<>&|^!~?:()])
+    """, re.X)
+_charEscapes = {'n': 10, 't': 9, 'r': 13, '0': 0, 'a': 7, 'b': 8, 'f': 12,
+                'v': 11, 'e': 27, '\\': 92, "'": 39, '"': 34, '?': 63}
+
+# Binary operators: C precedence (higher binds tighter) and the Python
+# code template for each. '&&' and '||' short-circuit and give 0 or 1.
+_binaryOps = {
+    '||': (4, "(1 if %s or %s else 0)"),
+    '&&': (5, "(1 if %s and %s else 0)"),
+    '|':  (6, "(%s | %s)"),
+    '^':  (7, "(%s ^ %s)"),
+    '&':  (8, "(%s & %s)"),
+    '==': (9, "(%s == %s)"),
+    '!=': (9, "(%s != %s)"),
+    '<':  (10, "(%s < %s)"),
+    '>':  (10, "(%s > %s)"),
+    '<=': (10, "(%s <= %s)"),
+    '>=': (10, "(%s >= %s)"),
+    '<<': (11, "(%s << %s)"),
+    '>>': (11, "(%s >> %s)"),
+    '+':  (12, "(%s + %s)"),
+    '-':  (12, "(%s - %s)"),
+    '*':  (13, "(%s * %s)"),
+    '/':  (13, "_div(%s, %s)"),
+    '%':  (13, "_mod(%s, %s)"),
+}
+_unaryOps = {'!': "(not %s)", '~': "(~%s)", '-': "(-%s)", '+': "(+%s)"}
+
+
+def _cdiv(a, b):
+    if b == 0:
+        raise PreprocessError("division by zero")
+    q = abs(a) // abs(b)
+    return -q if (a < 0) != (b < 0) else q
+
+def _cmod(a, b):
+    return a - _cdiv(a, b) * b
+
+
+_expanding = set()  # names of the string-valued macros being evaluated
+
+def _macroValue(defines, name):
+    """Return the value of macro 'name' as used in an #if expression.
+
+    Like in C, undefined macros are 0. A string value is the macro's
+    replacement text and is evaluated as an expression itself.
+    """
+    try:
+        value = defines[name]
+    except KeyError:
+        return 0
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        if name in _expanding:
+            return 0    # a self-referential macro isn't expanded again
+        _expanding.add(name)
+        try:
+            return _compileExpression(value).evaluate(defines)
+        except PreprocessError as ex:
+            raise PreprocessError("cannot evaluate macro %s (%r): %s"
+                                  % (name, value, ex.errmsg))
+        finally:
+            _expanding.discard(name)
+    raise PreprocessError("cannot evaluate macro %s (%r)" % (name, value))
+
+
+_undefined = object()   # the "value" of undefined macros in cache keys
+_missing = object()
+_deleted = object()     # tombstone for a macro #undef'd in a MacroTable
+
+class _CExpression(object):
+    """A C preprocessor constant expression, as in #if and #elif.
+
+    The expression is parsed once (supporting "defined", the unary,
+    binary and ternary operators, character literals and integer
+    suffixes) and compiled to a Python function of the defines. The
+    parse tree is kept in 'ast' and the names of all macros that the
+    value depends on in 'names'.
+
+    The result is also remembered for the values of those macros (the
+    value, or whether the macro is undefined), so evaluating again with
+    the same inputs is a dict lookup. Results depending on string
+    values are not remembered as those can refer to yet other macros.
+    'hits' and 'misses' count how well that works.
+
+    AST nodes are tuples:
+
+        ("num", <value>)
+        ("name", <macro>)
+        ("defined", <macro>)
+        ("unary", <op>, <operand>)
+        ("binary", <op>, <left>, <right>)
+        ("cond", <test>, <if-true>, <if-false>)
+    """
+    _maxResults = 256   # remembered results per expression
+
+    def __init__(self, text):
+        self.text = text
+        self.names = set()
+        self._tokens = self._tokenize(text)
+        self._pos = 0
+        self.ast = self._parseExpr(0)
+        if self._pos != len(self._tokens):
+            self._error("unexpected %r" % self._tokens[self._pos][1])
+        del self._tokens
+        self._nameList = sorted(self.names)
+        self._results = {}  # values of the macros in 'names' -> result
+        self.hits = self.misses = 0
+        code = "lambda _d: " + self._code(self.ast)
+        self._func = eval(compile(code, "<#if %s>" % text, "eval"),
+                          {"_v": _macroValue, "_div": _cdiv, "_mod": _cmod})
+
+    def _error(self, msg):
+        raise PreprocessError("invalid expression '%s': %s"
+                              % (self.text.strip(), msg))
+
+    def _tokenize(self, text):
+        tokens = []
+        pos = 0
+        while pos < len(text):
+            match = _exprTokenRe.match(text, pos)
+            if not match:
+                self._error("unexpected %r" % text[pos])
+            pos = match.end()
+            kind = match.lastgroup
+            if kind == "space":
+                continue
+            token = match.group()
+            if kind == "num":
+                digits = token.rstrip("uUlL")
+                try:
+                    if digits[:2] in ("0x", "0X"):
+                        value = int(digits, 16)
+                    elif digits.startswith("0"):
+                        value = int(digits, 8)
+                    else:
+                        value = int(digits)
+                except ValueError:
+                    self._error("bad number %r" % token)
+                tokens.append(("num", value))
+            elif kind == "char":
+                tokens.append(("num", self._charValue(token)))
+            else:
+                tokens.append((kind, token))
+        return tokens
+
+    def _charValue(self, token):
+        body = token[token.index("'")+1:-1]
+        if not body.startswith("\\"):
+            value = 0
+            for ch in body:     # multi-char constants, as GCC does
+                value = (value << 8) | (ord(ch) & 0xFF)
+            return value
+        esc = body[1:]
+        if esc[:1] in ("x", "X"):
+            return int(esc[1:], 16)
+        elif esc[:1].isdigit():
+            return int(esc, 8)
+        elif esc in _charEscapes:
+            return _charEscapes[esc]
+        self._error("bad character constant %s" % token)
+
+    def _next(self):
+        try:
+            token = self._tokens[self._pos]
+        except IndexError:
+            self._error("unexpected end of expression")
+        self._pos += 1
+        return token
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None)
+
+    def _expect(self, op):
+        if self._next() != ("op", op):
+            self._error("expected '%s'" % op)
+
+    def _parseExpr(self, minPrec):
+        left = self._parseUnary()
+        while True:
+            kind, op = self._peek()
+            if kind != "op":
+                break
+            if op == "?":
+                if minPrec > 3:
+                    break
+                self._pos += 1
+                ifTrue = self._parseExpr(0)
+                self._expect(":")
+                ifFalse = self._parseExpr(3)    # right associative
+                left = ("cond", left, ifTrue, ifFalse)
+                continue
+            if op not in _binaryOps or _binaryOps[op][0] < minPrec:
+                break
+            self._pos += 1
+            right = self._parseExpr(_binaryOps[op][0] + 1)
+            left = ("binary", op, left, right)
+        return left
+
+    def _parseUnary(self):
+        kind, token = self._next()
+        if kind == "num":
+            return ("num", token)
+        elif kind == "name":
+            if token == "defined":
+                paren = self._peek() == ("op", "(")
+                if paren:
+                    self._pos += 1
+                kind, name = self._next()
+                if kind != "name":
+                    self._error("expected a macro name after 'defined'")
+                if paren:
+                    self._expect(")")
+                self.names.add(name)
+                return ("defined", name)
+            self.names.add(token)
+            return ("name", token)
+        elif token == "(":
+            node = self._parseExpr(0)
+            self._expect(")")
+            return node
+        elif token in _unaryOps:
+            return ("unary", token, self._parseUnary())
+        self._error("unexpected %r" % token)
+
+    def _code(self, node):
+        kind = node[0]
+        if kind == "num":
+            return repr(node[1])
+        elif kind == "name":
+            return "_v(_d, %r)" % node[1]
+        elif kind == "defined":
+            return "(%r in _d)" % node[1]
+        elif kind == "unary":
+            return _unaryOps[node[1]] % self._code(node[2])
+        elif kind == "binary":
+            return _binaryOps[node[1]][1] % (self._code(node[2]),
+                                             self._code(node[3]))
+        else:
+            return "(%s if %s else %s)" % (self._code(node[2]),
+                self._code(node[1]), self._code(node[3]))
+
+    def evaluate(self, defines):
+        get = defines.get
+        key = tuple([get(name, _undefined) for name in self._nameList])
+        try:
+            result = self._results[key]
+            self.hits += 1
+            return result
+        except KeyError:
+            pass
+        except TypeError:   # unhashable macro value
+            key = None
+        self.misses += 1
+        try:
+            result = self._func(defines)
+        except (TypeError, ValueError, OverflowError) as ex:
+            raise PreprocessError("cannot evaluate '%s': %s"
+                                  % (self.text.strip(), ex))
+        if key is not None:
+            for value in key:
+                if isinstance(value, str):
+                    break
+            else:
+                if len(self._results) >= self._maxResults:
+                    self._results.clear()
+                self._results[key] = result
+        return result
+
+
+_compiledExprs = {}     # expression text -> _CExpression
+
+def _compileExpression(expr):
+    try:
+        return _compiledExprs[expr]
+    except KeyError:
+        compiled = _compiledExprs[expr] = _CExpression(expr)
+        return compiled
+
 
 def _evaluate(expr, defines):
-    expr = expr.replace("||","|") # Replace logic operators.
-    expr = expr.replace("&&","&")
-    expr = expr.replace("!defined", "ndefined") # Deal with !.
-    expr = expr.replace("! defined", "ndefined")
-    expr = re.sub("(\s*/\*.*\*/\s*)","",expr) # Get rid of comment
-    
-    # Add '' around the variable.(This may solve the problem for the original project too?)
-    rule = re.compile("defined\s*[(]\s*([a-zA-Z_]+[a-zA-Z0-9_]*)\s*[)]")
-    match = rule.search(expr)
-    if match:
-        expr = re.sub(rule,"defined ( '\g<1>' )",expr)
-    
+    """Evaluate the #if/#elif expression 'expr' with the given defines.
+
+    Each distinct expression is compiled once, then only evaluated.
+    Raises PreprocessError if it is invalid.
+    """
+    return _compileExpression(expr).evaluate(defines)
+
+
+class _IncludeIndex(object):
+    """Index of every file under a workspace, used to resolve #include's.
+
+    The workspace is walked once (with os.scandir, in the same top-down
+    order as os.walk) and all later lookups are answered from memory.
+    Results, including failed lookups, are cached so that resolving the
+    same #include again is a single dict lookup.
+
+    If 'cachePath' is given the index is also saved there, and reloaded
+    on the next run: only directories whose mtime has changed since are
+    listed again, the others cost a single stat() each.
+
+    Like os.walk(), symlinked directories are not walked: a path through
+    one is looked up on the filesystem. Paths are compared as
+    os.path.normcase() makes them, e.g. case-insensitively on Windows.
+    """
+    _cacheVersion = 2
+
+    def __init__(self, workspace, cachePath=None):
+        self.workspace = os.path.normpath(workspace)
+        self.cachePath = cachePath
+        self.dirs = []          # directories, in os.walk() order
+        # As for os.path.normcase(), which the following are keyed by:
+        self._caseWorkspace = os.path.normcase(self.workspace)
+        self.dirOrder = {}      # directory -> index in self.dirs
+        self.files = set()      # normalized paths of all indexed files
+        self.byName = {}        # basename -> [paths, in os.walk() order]
+        self.links = set()      # symlinked directories
+        self._resolved = {}     # (fromdir, f, includePath) -> path or None
+        # path outside the workspace, or through a link -> exists?
+        self._outside = {}
+        # reldir -> (mtime_ns, file names, subdir names, link names), as
+        # listed
+        self._listings = {}
+        # keys of the lookups to forget on refresh(), see resolve()
+        self._volatile = []
+        cached = self._loadCache()
+        self._index(self._listAll(cached))
+        if self.cachePath and self._listings != cached:
+            self._saveCache()
+
+    def refresh(self, changedDirs=()):
+        """Bring the index up to date with the workspace. Each directory
+        costs a stat(): only those whose mtime changed, or that are in
+        "changedDirs", are listed again, and only their files are
+        re-indexed. Of the cached lookups, only those that may now
+        resolve differently are forgotten: the failed ones, those that
+        looked outside the workspace and those of the names of files
+        that came or went. Returns true if files or directories came or
+        went.
+        """
+        stale = set(path[len(self.workspace)+1:] for path in changedDirs)
+        listings = self._listings
+        cached = dict((reldir, listing) for reldir, listing
+                      in listings.items() if reldir not in stale)
+        dirs = self._listAll(cached)
+        if self.cachePath and self._listings != listings:
+            self._saveCache()
+        for key in self._volatile:
+            self._resolved.pop(key, None)
+        self._volatile = []
+        self._outside = {}
+        changed = dirs != self.dirs
+        if changed:
+            common = set(dirs) & set(self.dirs)
+            if [d for d in self.dirs if d in common] \
+               != [d for d in dirs if d in common]:
+                # The walk order changed (not seen in practice): start
+                # over.
+                self.files = set()
+                self.byName = {}
+                self.links = set()
+                self._resolved = {}
+                self._index(dirs)
+                return True
+            self.dirs = dirs
+            self.dirOrder = dict((os.path.normcase(top), i)
+                                 for i, top in enumerate(dirs))
+        # (A file replaced by a rename changes the mtime only.)
+        touched = set()     # names of the files that came or went
+        for reldir in set(listings) | set(self._listings):
+            names, links = listings.get(reldir, (None, (), (), ()))[1::2]
+            newNames, newLinks = self._listings.get(reldir,
+                                                    (None, (), (), ()))[1::2]
+            if names == newNames and links == newLinks:
+                continue
+            top = reldir and os.path.join(self.workspace, reldir) \
+                  or self.workspace
+            for name in links:
+                self.links.discard(os.path.normcase(os.path.join(top, name)))
+            for name in newLinks:
+                self.links.add(os.path.normcase(os.path.join(top, name)))
+            names, newNames = set(names), set(newNames)
+            for name in names - newNames:
+                self._removeFile(os.path.join(top, name), name)
+                touched.add(os.path.normcase(name))
+            for name in newNames - names:
+                self._addFile(os.path.join(top, name), name)
+                touched.add(os.path.normcase(name))
+        dirOrder = self.dirOrder
+        for name in touched:
+            paths = self.byName.get(name)
+            if paths:
+                paths.sort(key=lambda path: dirOrder[os.path.dirname(path)])
+        if touched:
+            for key, path in list(self._resolved.items()):
+                if path is not None and os.path.normcase(
+                        os.path.basename(path)) in touched:
+                    del self._resolved[key]
+        return changed or bool(touched)
+
+    def _loadCache(self):
+        if not self.cachePath:
+            return {}
+        try:
+            fin = open(self.cachePath, 'rb')
+            try:
+                data = pickle.loads(zlib.decompress(fin.read()))
+            finally:
+                fin.close()
+        except Exception:
+            return {}
+        if not isinstance(data, dict) \
+           or data.get("version") != self._cacheVersion \
+           or data.get("workspace") != self.workspace:
+            return {}
+        return data["listings"]
+
+    def _saveCache(self):
+        # A directory changed within the same mtime tick as this save
+        # would look unchanged next time: don't trust very recent mtimes.
+        horizon = (time.time() - 2) * 1e9
+        listings = {}
+        for reldir, (mtime, names, subdirs, links) \
+                in self._listings.items():
+            if mtime is not None and mtime > horizon:
+                mtime = None
+            listings[reldir] = (mtime, names, subdirs, links)
+        data = {"version": self._cacheVersion, "workspace": self.workspace,
+                "listings": listings}
+        tmpPath = "%s.%d.tmp" % (self.cachePath, os.getpid())
+        try:
+            cacheDir = os.path.dirname(self.cachePath)
+            if cacheDir and not os.path.isdir(cacheDir):
+                os.makedirs(cacheDir)
+            fout = open(tmpPath, 'wb')
+            try:
+                fout.write(zlib.compress(pickle.dumps(data, 2)))
+            finally:
+                fout.close()
+            os.replace(tmpPath, self.cachePath)
+        except (OSError, IOError):
+            # The cache is only an optimization.
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+    def _listDir(self, top):
+        names, subdirs, links = [], [], []
+        for entry in os.scandir(top):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                # Like os.walk(), don't descend into symlinked dirs.
+                if entry.is_symlink():
+                    links.append(entry.name)
+                else:
+                    subdirs.append(entry.name)
+            else:
+                names.append(entry.name)
+        return tuple(names), tuple(subdirs), tuple(links)
+
+    def _listAll(self, cached):
+        """List the workspace into self._listings, re-using the 'cached'
+        listing of each directory whose mtime didn't change. Returns the
+        directories in os.walk() order.
+        """
+        self._listings = {}
+        dirs = []
+        stack = [""]
+        while stack:
+            reldir = stack.pop()
+            top = reldir and os.path.join(self.workspace, reldir) \
+                  or self.workspace
+            try:
+                mtime = os.stat(top).st_mtime_ns
+                listing = cached.get(reldir)
+                if listing is not None and listing[0] == mtime:
+                    names, subdirs, links = listing[1:]
+                else:
+                    names, subdirs, links = self._listDir(top)
+            except OSError:
+                continue
+            self._listings[reldir] = (mtime, names, subdirs, links)
+            dirs.append(top)
+            stack.extend(reversed([os.path.join(reldir, d) for d in subdirs]))
+        return dirs
+
+    def _index(self, dirs):
+        self.dirs = dirs
+        self.dirOrder = dict((os.path.normcase(top), i)
+                             for i, top in enumerate(dirs))
+        for top in dirs:
+            listing = self._listings[top[len(self.workspace)+1:]]
+            for name in listing[1]:
+                self._addFile(os.path.join(top, name), name)
+            for name in listing[3]:
+                self.links.add(os.path.normcase(os.path.join(top, name)))
+
+    def walk(self):
+        """Generate (dirpath, filenames) for each workspace dir, in
+        os.walk() order, without touching the filesystem.
+        """
+        for top in self.dirs:
+            reldir = top[len(self.workspace)+1:]
+            yield top, self._listings[reldir][1]
+
+    def _addFile(self, path, name):
+        path, name = os.path.normcase(path), os.path.normcase(name)
+        self.files.add(path)
+        self.byName.setdefault(name, []).append(path)
+
+    def _removeFile(self, path, name):
+        path, name = os.path.normcase(path), os.path.normcase(name)
+        self.files.discard(path)
+        paths = self.byName.get(name, [])
+        if path in paths:
+            paths.remove(path)
+            if not paths:
+                del self.byName[name]
+
+    def _isInside(self, path):
+        path = os.path.normcase(path)
+        return path == self._caseWorkspace \
+               or path.startswith(self._caseWorkspace + os.sep)
+
+    def _throughLink(self, path):
+        """Return true if the normcase()'d 'path' in the workspace goes
+        through a symlinked directory.
+        """
+        while len(path) > len(self._caseWorkspace):
+            path = os.path.dirname(path)
+            if path in self.links:
+                return True
+        return False
+
+    def _mayGoThroughLink(self, f, fname, key):
+        # Whether resolving 'key' (to 'fname') may have looked at a path
+        # through a symlinked dir.
+        if os.sep in os.path.normpath(f):
+            return True
+        for path in [fname, key[0]] + list(key[2]):
+            if self._throughLink(os.path.normcase(path)):
+                return True
+        return False
+
+    def hasFile(self, path):
+        """Return true if 'path' is an indexed file."""
+        return os.path.normcase(path) in self.files
+
+    def _exists(self, path):
+        casePath = os.path.normcase(path)
+        if casePath in self.files:
+            return True
+        if self._isInside(path) \
+           and not (self.links and self._throughLink(casePath)):
+            return False
+        # Only paths escaping the workspace (e.g. "../foo.h" from the
+        # top dir) or going through a symlinked dir need the filesystem;
+        # remember the answer.
+        try:
+            return self._outside[path]
+        except KeyError:
+            exists = self._outside[path] = os.path.isfile(path)
+            return exists
+
+    def _walkLookup(self, f):
+        """Return the first normpath(join(root, f)) that exists, trying
+        each workspace directory 'root' in os.walk() order.
+        """
+        if os.path.isabs(f):
+            fname = os.path.normpath(f)
+            return self._exists(fname) and fname or None
+        nf = os.path.normpath(f)
+        if nf.split(os.sep, 1)[0] != os.pardir:
+            # 'root' can be recovered from each file with a matching
+            # basename: pick the one whose root is walked first.
+            best = None
+            caseNf = os.path.normcase(nf)
+            suffix = os.sep + caseNf
+            for path in self.byName.get(os.path.basename(caseNf), ()):
+                if path.endswith(suffix):
+                    order = self.dirOrder.get(path[:-len(suffix)])
+                    if order is not None and (best is None or order < best):
+                        best = order
+            # Likewise for a root from which 'f' goes through a link.
+            parts = caseNf.split(os.sep)[:-1]
+            for link in self.links:
+                for i in range(len(parts)):
+                    suffix = os.sep + os.sep.join(parts[:i+1])
+                    if not link.endswith(suffix):
+                        continue
+                    order = self.dirOrder.get(link[:-len(suffix)])
+                    if order is not None and (best is None or order < best) \
+                       and self._exists(self.dirs[order] + os.sep + nf):
+                        best = order
+            if best is None:
+                return None
+            return self.dirs[best] + os.sep + nf
+        for root in self.dirs:
+            fname = os.path.normpath(os.path.join(root, f))
+            if self._exists(fname):
+                return fname
+        return None
+
+    def resolve(self, f, fromdir, includePath=()):
+        """Return the path for '#include "f"' in a file in 'fromdir',
+        or None if it cannot be found.
+
+        The including file's directory is tried first, then each
+        'includePath' dir and finally the whole workspace.
+        """
+        key = (fromdir, f, tuple(includePath))
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        fname = None
+        for d in [fromdir] + list(includePath):
+            candidate = os.path.normpath(os.path.join(d, f))
+            if self._exists(candidate):
+                fname = candidate
+                break
+        else:
+            fname = self._walkLookup(f)
+        self._resolved[key] = fname
+        # Failed lookups, and those that may have looked outside the
+        # workspace, are not followed by the index: redo them after a
+        # refresh().
+        if fname is None or os.path.isabs(f) \
+           or os.path.normpath(f).split(os.sep, 1)[0] == os.pardir \
+           or not self._isInside(fromdir) \
+           or not all(self._isInside(d) for d in includePath) \
+           or (self.links and self._mayGoThroughLink(f, fname, key)):
+            self._volatile.append(key)
+        return fname
+
+
+_includeIndexes = {}    # workspace -> _IncludeIndex
+
+def _getIncludeIndex(workspace, cachePath=None):
+    """Return the include index for 'workspace', building it on first use.
+
+    "cachePath" is where to persist the index between runs (optional).
+    """
     try:
-        rv = eval(expr, {'defined':lambda v: v in defines,'ndefined':lambda v: v not in defines}, defines)
-    except Exception as ex:
-        msg = str(ex)
-        print(expr, msg)
-        sys.exit()
-    return rv
+        return _includeIndexes[workspace]
+    except KeyError:
+        index = _includeIndexes[workspace] = _IncludeIndex(workspace,
+                                                           cachePath)
+        return index
 
+def _refreshIncludeIndex(workspace):
+    """Bring the include index of 'workspace', if one was built, up to
+    date with the files on disk (a stat() per directory) and forget the
+    lookups made with it, failed ones included.
+    """
+    index = _includeIndexes.get(workspace)
+    if index is not None:
+        index.refresh()
 
-#---- module API
 
-def preprocess(workspace, infile, outfile=sys.stdout, defines={},
-               force=0, keepLines=0, includePath=[],
-               substitute=0, include_substitute=0):
-    if isinstance(infile, tuple):
-        infile, from_, to_, last_to_line = infile
+# Patterns are modified to fit my own use.
+# No need for comment patterns according to file type so removed.
+_stmts = ['\s*#\s*(?P<op>if|elif|ifdef|ifndef)\s+(?P<expr>.*)$',
+          '\s*#\s*(?P<op>else|endif)(\s*/\*.*\*/\s*)?\s*$',
+          '\s*#\s*(?P<op>error)\s+(?P<error>.*?)(\s*/\*.*\*/\s*)?$',
+          '\s*#\s*(?P<op>define)\s+(?P<var>[\S]*)\s*[( ]?(\s?(?P<val>\S+))?[ )]?\s*(/*.*)?(\s*/\*.*\*/\s*)?$',
+          '\s*#\s*(?P<op>undef)\s+(?P<var>\S+)',
+          '\s*#\s*(?P<op>include) +"(?P<fname>.*?)" +(?P<fromto>fromto_?):\s+(?P<part>.+\n)',
+          '\s*#\s*(?P<op>include)\s+"(?P<fname>.*?)"',
+          r'\s*#\s*(?P<op>include)\s+(?P<var>[\S]+?)',
+         ]
+_stmtRes = [re.compile(p) for p in _stmts]
+
+# Get rid of the 'u' after numbers meaning unsigned. Starting with the
+# literal lets the regex engine skip ahead to each "u".
+_popuRe = re.compile("u(?<=[0-9]u)")
+_popuBytesRe = re.compile(b"u(?<=[0-9]u)")
+_macroNameRe = re.compile(r"\s*([a-zA-Z_]\w*)")
+
+
+def _splitLines(text):
+    """Split 'text' into lines like file.readlines() does (only at "\n",
+    unlike str.splitlines()).
+    """
+    newline = isinstance(text, str) and "\n" or b"\n"
+    lines = [line + newline for line in text.split(newline)]
+    if lines[-1] == newline:
+        del lines[-1]
     else:
-        from_, to_, last_to_line = None, None, None
-
-    # Patterns are modified to fit my own use.
-    # No need for comment patterns according to file type so removed.
-    stmts = ['\s*#\s*(?P<op>if|elif|ifdef|ifndef)\s+(?P<expr>.*)$',
-             '\s*#\s*(?P<op>else|endif)(\s*/\*.*\*/\s*)?\s*$',
-             '\s*#\s*(?P<op>error)\s+(?P<error>.*?)(\s*/\*.*\*/\s*)?$',
-             '\s*#\s*(?P<op>define)\s+(?P<var>[\S]*)\s*[( ]?(\s?(?P<val>\S+))?[ )]?\s*(/*.*)?(\s*/\*.*\*/\s*)?$',
-             '\s*#\s*(?P<op>undef)\s+(?P<var>[\S]*?)',
-             '\s*#\s*(?P<op>include) +"(?P<fname>.*?)" +(?P<fromto>fromto_?):\s+(?P<part>.+\n)',
-             '\s*#\s*(?P<op>include)\s+"(?P<fname>.*?)"',
-             r'\s*#\s*(?P<op>include)\s+(?P<var>[\S]+?)',
-            ]
-    stmtRes = [re.compile(p) for p in stmts]
-
-    # Process the input file.
-    # (Would be helpful if I knew anything about lexing and parsing
-    # simple grammars.)
-    fin = open(infile, 'r')
-    lines = fin.readlines()
-    if from_ is not None:
-        from_line = -1
-        to_line = -1
-        for i in range(len(lines)):
-            if re.search(from_, lines[i]):
-                from_line = i
-            if to_ != '' and from_line != -1:
-                # not to end of file and has found from_ line
-                if re.search(to_, lines[i]):
-                    to_line = i if last_to_line else i-1
+        lines[-1] = lines[-1][:-1]
+    return lines
+
+
+def _parseDirective(line, lineNum):
+    """Return the node for 'line' (see _parseText()), or None if it
+    isn't a preprocessor statement.
+    """
+    for stmtRe in _stmtRes:
+        match = stmtRe.match(line)
+        if match:
+            break
+    else:
+        return None
+    op = match.group("op")
+    if op in ("if", "ifdef", "ifndef"):
+        expr = match.group("expr")
+        if op != "if":
+            name = _macroNameRe.match(expr)
+            expr = "defined(%s)" % (name and name.group(1) or expr)
+            if op == "ifndef":
+                expr = "!" + expr
+        return ("if", lineNum, line, expr, op)
+    elif op == "elif":
+        return (op, lineNum, line, match.group("expr"))
+    elif op in ("else", "endif"):
+        return (op, lineNum, line)
+    elif op == "error":
+        return (op, lineNum, line, match.group("error"))
+    elif op == "define":
+        return (op, lineNum, line) + match.group("var", "val")
+    elif op == "undef":
+        return (op, lineNum, line, match.group("var"))
+    else:   # include
+        groups = match.groupdict()
+        return (op, lineNum, line, groups.get("fname"), groups.get("var"),
+                groups.get("fromto"), groups.get("part"))
+
+
+def _parseText(text):
+    """Parse the text of a file into a list of nodes, one per directive
+    line or run of plain text lines. Nodes are tuples:
+
+        (None, <first-lineno>, <text>, <num-lines>)         text
+        ("if", <lineno>, <line>, <expr>, <op>)              #if/ifdef/ifndef
+        ("elif", <lineno>, <line>, <expr>)
+        ("else"|"endif", <lineno>, <line>)
+        ("error", <lineno>, <line>, <message>)
+        ("define", <lineno>, <line>, <var>, <val>)
+        ("undef", <lineno>, <line>, <var>)
+        ("include", <lineno>, <line>, <fname>, <var>, <fromto>, <part>)
+
+    where <expr> has already been rewritten for #ifdef/#ifndef (as
+    "defined(X)" and "!defined(X)") so that it can be given to
+    _evaluate().
+
+    Only lines starting with (optional whitespace and) a "#" can be
+    directives, so the buffer is scanned for those with str.find() and
+    everything in between is kept as one slice of text.
+    """
+    if _popuRe.search(text):
+        text = _popuRe.sub("", text)
+    nodes = []
+    find, rfind, count = text.find, text.rfind, text.count
+    textStart = 0   # offset of the pending run of text lines
+    textLine = 1    # and its first line number
+    pos = 0
+    while True:
+        i = find("#", pos)
+        if i == -1:
+            break
+        start = rfind("\n", 0, i) + 1
+        end = find("\n", i)
+        end = end == -1 and len(text) or end + 1
+        pos = end
+        if start != i and not text[start:i].isspace():
+            continue
+
+        line = text[start:end]
+        lineNum = textLine + count("\n", textStart, start)
+        node = _parseDirective(line, lineNum)
+        if node is None:
+            continue
+        if start > textStart:
+            nodes.append((None, textLine, text[textStart:start],
+                          lineNum - textLine))
+        textStart = end
+        textLine = lineNum + 1
+        nodes.append(node)
+    if textStart < len(text):
+        rest = text[textStart:]
+        nodes.append((None, textLine, rest,
+                      rest.count("\n") + (not rest.endswith("\n"))))
+    return nodes
+
+
+def _parseBytes(data):
+    """Like _parseText(), for the undecoded content of a file (bytes or
+    a mmap). Text nodes are bytes slices of 'data' and so is the line of
+    a directive node; the other fields of directive nodes are decoded
+    as Latin-1, which can't fail and keeps directives (pure ASCII) as
+    they are.
+    """
+    nodes = []
+    find, rfind = data.find, data.rfind
+    size = len(data)
+    textStart = 0   # offset of the pending run of text lines
+    textLine = 1    # and its first line number
+    countedTo = 0   # newlines are counted up to here
+    countedLines = 1
+    pos = 0
+    while True:
+        i = find(b"#", pos)
+        if i == -1:
+            break
+        start = rfind(b"\n", 0, i) + 1
+        end = find(b"\n", i)
+        end = end == -1 and size or end + 1
+        pos = end
+        if start != i and not data[start:i].isspace():
+            continue
+
+        line = data[start:end]
+        if _popuBytesRe.search(line):
+            line = _popuBytesRe.sub(b"", line)
+        countedLines += data[countedTo:start].count(b"\n")
+        countedTo = start
+        node = _parseDirective(line.decode("latin-1"), countedLines)
+        if node is None:
+            continue
+        lineNum = countedLines
+        if start > textStart:
+            text = data[textStart:start]
+            if _popuBytesRe.search(text):
+                text = _popuBytesRe.sub(b"", text)
+            nodes.append((None, textLine, text, lineNum - textLine))
+        textStart = end
+        textLine = lineNum + 1
+        nodes.append(node[:2] + (line,) + node[3:])
+    if textStart < size:
+        rest = data[textStart:]
+        if _popuBytesRe.search(rest):
+            rest = _popuBytesRe.sub(b"", rest)
+        nodes.append((None, textLine, rest,
+                      rest.count(b"\n") + (not rest.endswith(b"\n"))))
+    return nodes
+
+def _iterNodes(lines, chunkSize=65536):
+    """Generate the nodes of _parseText() from an iterable of lines (e.g.
+    a file), without holding more than one run of text lines of about
+    "chunkSize" characters. Lines of bytes give the nodes of
+    _parseBytes().
+    """
+    text = []
+    textSize = 0
+    textLine = 1
+    lineNum = 0
+    binary = None
+    for line in lines:
+        if binary is None:
+            binary = isinstance(line, bytes)
+            if binary:
+                empty, popuRe, hash_ = b"", _popuBytesRe, b"#"
+            else:
+                empty, popuRe, hash_ = "", _popuRe, "#"
+        lineNum += 1
+        if popuRe.search(line):
+            line = popuRe.sub(empty, line)
+        i = line.find(hash_)
+        if i != -1 and (i == 0 or line[:i].isspace()):
+            if binary:
+                node = _parseDirective(line.decode("latin-1"), lineNum)
+                if node is not None:
+                    node = node[:2] + (line,) + node[3:]
+            else:
+                node = _parseDirective(line, lineNum)
+            if node is not None:
+                if text:
+                    yield (None, textLine, empty.join(text), len(text))
+                    text = []
+                    textSize = 0
+                textLine = lineNum + 1
+                yield node
+                continue
+        text.append(line)
+        textSize += len(line)
+        if textSize >= chunkSize:
+            yield (None, textLine, empty.join(text), len(text))
+            text = []
+            textSize = 0
+            textLine = lineNum + 1
+    if text:
+        yield (None, textLine, empty.join(text), len(text))
+
+
+class _ParsedFile(object):
+    """The parsed form of a file (or a 'fromto' region of one), see
+    _parseText(). This doesn't depend on any defines, so it can be
+    re-used for every later visit to the file.
+
+    A file in a classic include guard:
+
+        <text>
+        #ifndef MACRO             (or: #if !defined(MACRO))
+        #define MACRO ...
+        ...
+        #endif
+        <text>
+
+    has 'guardMacro' set. Including such a file again while MACRO is
+    defined can't do anything but re-emit the surrounding text and the
+    #define/#include lines within the guard (which are always written
+    out), so that output is kept for replaying without walking the
+    nodes again; also as (<line number>, <text>) pieces, for LineMap's.
+
+    Likewise 'branches' maps the line of each #if/#elif/#else to the
+    span of its branch, (<index of its first node>, <index of the next
+    #elif/#else/#endif of the block>): a false branch is jumped over in
+    one go, see skippedBranch(). If the blocks are unbalanced,
+    'blockError' has the (<message>, <line number>, <line>) to report
+    before walking the file.
+    """
+    _notDefinedRe = re.compile(r"^\s*!\s*defined\s*\(\s*([a-zA-Z_]\w*)\s*\)\s*$")
+    _commentRe = re.compile(r"(\s*/\*.*\*/\s*)")
+
+    def __init__(self, nodes, numLines, stat, digest=None):
+        self.nodes = nodes
+        self.numLines = numLines
+        self.stat = stat        # (mtime, size) of the file when parsed
+        self.digest = digest    # hash of the whole file's content
+        self.guardMacro = None
+        self._findGuard()
+        self._findBranches()
+        self._skippedBranches = {}
+        self._directiveCounts = None
+
+    def directiveCounts(self):
+        """Return {<directive>: <number of its lines in the file>}."""
+        if self._directiveCounts is None:
+            counts = {}
+            for node in self.nodes:
+                op = node[0]
+                if op is None:
+                    continue
+                elif op == "if":
+                    op = node[4]    # or "ifdef", "ifndef"
+                counts[op] = counts.get(op, 0) + 1
+            self._directiveCounts = counts
+        return self._directiveCounts
+
+    def _guardedMacro(self, node):
+        if node[0] != "if" or node[4] == "ifdef":
+            return None
+        match = self._notDefinedRe.match(self._commentRe.sub("", node[3]))
+        return match and match.group(1)
+
+    def _findGuard(self):
+        nodes = self.nodes
+        start = nodes and nodes[0][0] is None and 1 or 0
+        if len(nodes) < start + 3:
+            return
+        macro = self._guardedMacro(nodes[start])
+        if not macro or nodes[start+1][0] != "define" \
+           or nodes[start+1][3] != macro:
+            return
+        depth = 0
+        for end in range(start, len(nodes)):
+            op = nodes[end][0]
+            if op == "if":
+                depth += 1
+            elif op == "endif":
+                depth -= 1
+                if depth == 0:
                     break
+            elif op in ("elif", "else") and depth == 1:
+                return
+        else:
+            return
+        if len(nodes) > end + 2 or (len(nodes) == end + 2
+                                    and nodes[end+1][0] is not None):
+            return
+        skipped, skippedKeepLines = _skippedOutput(nodes[start:end+1])[:2]
+        newline = isinstance(nodes[start][2], str) and "\n" or b"\n"
+        self.guardMacro = macro
+        self.guardPrefix = nodes[:start]
+        self.guardSuffix = nodes[end+1:]
+        self.guardSkippedPieces = skipped
+        self.guardSkippedKeepLinesPieces = skippedKeepLines
+        self.guardSkipped = newline[:0].join([text for n, text in skipped])
+        self.guardSkippedKeepLines = newline[:0].join(
+            [text for n, text in skippedKeepLines])
+
+    def _findBranches(self):
+        nodes = self.nodes
+        self.branches = branches = {}
+        self.blockError = None
+        blocks = []     # [<index of #if>, <of its last branch>, <had #else>]
+        for i, node in enumerate(nodes):
+            op = node[0]
+            if op == "if":
+                blocks.append([i, i, False])
+            elif op in ("elif", "else", "endif"):
+                if not blocks:
+                    self.blockError = ("#%s stmt without leading #if stmt"
+                                       % op, node[1], node[2])
+                    return
+                block = blocks[-1]
+                if block[2] and op != "endif":
+                    self.blockError = ("illegal #%s after #else in same #if "
+                                       "block" % op, node[1], node[2])
+                    return
+                branches[nodes[block[1]][1]] = (block[1] + 1, i)
+                if op == "endif":
+                    blocks.pop()
+                else:
+                    block[1] = i
+                    block[2] = op == "else"
+        if blocks:
+            node = nodes[blocks[-1][0]]
+            self.blockError = ("unterminated #if block", node[1], node[2])
+
+    def skippedBranch(self, lineNum):
+        """Return (<index of the next #elif/#else/#endif>, <output>,
+        <output with keepLines>, <output pieces>, <pieces with
+        keepLines>, <number of text lines>) for the false branch of the
+        #if/#elif/#else on line 'lineNum' (see _skippedOutput()).
+        """
+        skipped = self._skippedBranches.get(lineNum)
+        if skipped is None:
+            start, end = self.branches[lineNum]
+            pieces, keepLinesPieces, textLines = _skippedOutput(
+                self.nodes[start:end])
+            newline = isinstance(self.nodes[end][2], str) and "\n" or b"\n"
+            skipped = self._skippedBranches[lineNum] = (
+                end, newline[:0].join([text for n, text in pieces]),
+                newline[:0].join([text for n, text in keepLinesPieces]),
+                pieces, keepLinesPieces, textLines)
+        return skipped
+
+
+def _skippedOutput(nodes):
+    """Return what walking 'nodes' in a false #if branch outputs, as
+    (<pieces>, <pieces with keepLines>, <number of text lines>), pieces
+    being (<line number>, <text>): only the #define and #include lines
+    are written out, and with keepLines a newline for every other line.
+    """
+    pieces, keepLinesPieces, textLines = [], [], 0
+    newline = nodes and isinstance(nodes[0][2], bytes) and b"\n" or "\n"
+    for node in nodes:
+        op = node[0]
+        if op is None:
+            keepLinesPieces.append((node[1], newline * node[3]))
+            textLines += node[3]
+            continue
+        if op in ("define", "include"):
+            pieces.append((node[1], node[2]))
+            keepLinesPieces.append((node[1], node[2]))
+        keepLinesPieces.append((node[1], newline))
+    return pieces, keepLinesPieces, textLines
+
+
+def _readFile(path, binary, size=None):
+    """Return the content of 'path' and its hash (see _ParsedFile.digest).
+    With "binary" the content is bytes, else it is decoded like a file
+    opened in text mode. "size", if given, is the size of the file as
+    it was stat'ed.
+    """
+    fin = open(path, 'rb')
+    try:
+        if binary and size:
+            # Scanned in place: only the slices for the nodes are copied.
+            data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = fin.read()
+    finally:
+        fin.close()
+    digest = hashlib.md5(data).hexdigest()
+    if not binary:
+        data = io.TextIOWrapper(io.BytesIO(data)).read()
+    return data, digest
+
+
+class _RegionSource(object):
+    """The lines of a file that "#include ... fromto:" regions are taken
+    from, for extracting many regions with one read of the file.
+
+    A region is found by scanning the lines for the "from" and "to"
+    patterns; the line numbers that each pattern matches are computed
+    once and then kept, so that a region is found with a couple of
+    bisections, and regions sharing a pattern share the scan. Patterns
+    that are plain words (maybe anchored with "^" or "$"), as they
+    usually are, are looked for in the whole text instead of line by
+    line.
+    """
+    _wordPatternRe = re.compile(r"^(\^?)(\w+)(\$?)\Z")
+
+    def __init__(self, text, stat, digest, binary):
+        self.text = text
+        self.lines = _splitLines(text)
+        self.stat = stat
+        self.digest = digest
+        self.binary = binary
+        self._starts = None     # offset of each line in the text
+        self._matches = {}      # pattern -> sorted line numbers it matches
+
+    def _findWord(self, word, atStart, atEnd):
+        if self._starts is None:
+            starts = self._starts = [0]
+            for line in self.lines:
+                starts.append(starts[-1] + len(line))
+        text, starts, lines = self.text, self._starts, self.lines
+        if self.binary:
+            newline = b"\n"
+        else:
+            newline = "\n"
+        matches = []
+        pos = text.find(word)
+        while pos != -1:
+            i = bisect.bisect_right(starts, pos) - 1
+            # "$" matches before the newline ending the line too.
+            end = starts[i+1] - lines[i].endswith(newline)
+            if (not atStart or pos == starts[i]) \
+               and (not atEnd or pos + len(word) == end) \
+               and (not matches or matches[-1] != i):
+                matches.append(i)
+            pos = text.find(word, pos + 1)
+        return matches
+
+    def _matchingLines(self, pattern):
+        try:
+            return self._matches[pattern]
+        except KeyError:
+            pass
+        match = self._wordPatternRe.match(pattern)
+        if match:
+            atStart, word, atEnd = match.groups()
+            if self.binary:
+                word = word.encode("latin-1")
+            matches = self._findWord(word, atStart, atEnd)
+        else:
+            if self.binary:
+                search = re.compile(pattern.encode("latin-1")).search
+            else:
+                search = re.compile(pattern).search
+            matches = [i for i, line in enumerate(self.lines) if search(line)]
+        self._matches[pattern] = matches
+        return matches
+
+    def region(self, from_, to_, last_to_line):
+        """Return the text of the region: from the last line matching
+        'from_' before the first line matching 'to_' after the first
+        'from_' line, up to that 'to_' line (included if
+        "last_to_line"), or to the end of the file if 'to_' is empty or
+        doesn't match. Without a 'from_' line it is the last line.
+        """
+        lines = self.lines
+        froms = self._matchingLines(from_)
+        if froms:
+            from_line = froms[-1]
+        else:
+            from_line = -1
+        to_line = -1
+        if to_ and froms:
+            tos = self._matchingLines(to_)
+            i = bisect.bisect_left(tos, froms[0])
+            if i < len(tos):
+                to_line = tos[i]
+                from_line = froms[bisect.bisect_right(froms, to_line) - 1]
+                if not last_to_line:
+                    to_line -= 1
         if to_line == -1:
+            # (Also when the region would end before line 0.)
             lines = lines[from_line:]
         else:
             lines = lines[from_line:to_line+1]
+        if self.binary:
+            return b"".join(lines)
+        return "".join(lines)
+
+
+_regionSources = {}     # (path, binary) -> _RegionSource
+
+def _getRegionSource(path, stat, binary):
+    source = _regionSources.get((path, binary))
+    if source is None or source.stat != stat:
+        data, digest = _readFile(path, binary)
+        source = _regionSources[(path, binary)] = _RegionSource(
+            data, stat, digest, binary)
+    return source
 
-    fin.close()
-    if isinstance(outfile, (str, bytes)):
-        if force and os.path.exists(outfile):
-            os.chmod(outfile, 0o777)
-            os.remove(outfile)
-        fout = open(outfile, 'w')
+
+_parsedFiles = {}   # path or (path, from_, to_, last_to_line) -> _ParsedFile
+_parsedBinaryFiles = {}     # the same, parsed with _parseBytes()
+
+def _numLines(nodes):
+    if not nodes:
+        return 0
+    node = nodes[-1]
+    if node[0] is None:
+        return node[1] + node[3] - 1
+    return node[1]
+
+
+def _getParsedFile(infile, from_=None, to_=None, last_to_line=None,
+                   cache=True, binary=0, stats=None):
+    """Return the _ParsedFile for 'infile' (or the given region of it),
+    re-using the cached one if the file hasn't changed.
+
+    If "cache" is false a newly parsed file is not added to the cache.
+    With "binary" the file is parsed as bytes, see _parseBytes(). The
+    time taken is added to "stats" (a PreprocessStats) if given.
+    """
+    if stats is not None:
+        start = time.perf_counter()
+    if from_ is None:
+        key = infile
+    else:
+        key = (infile, from_, to_, last_to_line)
+    if binary:
+        parsedFiles = _parsedBinaryFiles
     else:
-        fout = outfile
+        parsedFiles = _parsedFiles
+    st = os.stat(infile)
+    stat = (st.st_mtime_ns, st.st_size)
+    parsed = parsedFiles.get(key)
+    if parsed is not None and parsed.stat == stat:
+        if stats is not None:
+            stats._addTime("read", start)
+        return parsed
 
-    defines['__FILE__'] = infile
-    SKIP, EMIT = range(2) # states
-    states = [(EMIT,   # a state is (<emit-or-skip-lines-in-this-section>,
-               0,      #             <have-emitted-in-this-if-block>,
-               0)]     #             <have-seen-'else'-in-this-if-block>)
-    lineNum = 0
-    for line in lines:
-        lineNum += 1
-        defines['__LINE__'] = lineNum
-
-        # Get rid of the 'u' after numbers meaning unsigned.
-        popu = re.compile("([0-9])u")
-        pop = popu.search(line)
-        if pop:
-            line = re.sub(popu,"\g<1>",line)
-
-        # Is this line a preprocessor stmt line?
-        #XXX Could probably speed this up by optimizing common case of
-        #    line NOT being a preprocessor stmt line.
-        for stmtRe in stmtRes:
-            match = stmtRe.match(line)
-            if match:
-                break
+    if from_ is not None:
+        source = _getRegionSource(infile, stat, binary)
+        text = source.region(from_, to_, last_to_line)
+        digest = source.digest
+        data = None
+    else:
+        data, digest = _readFile(infile, binary, st.st_size)
+        text = data
+
+    if stats is not None:
+        start = stats._addTime("read", start)
+    if binary:
+        nodes = _parseBytes(text)
+    else:
+        nodes = _parseText(text)
+    if isinstance(data, mmap.mmap):
+        data.close()
+    parsed = _ParsedFile(nodes, _numLines(nodes), stat, digest)
+    if stats is not None:
+        stats._addTime("parse", start)
+    if cache:
+        parsedFiles[key] = parsed
+    elif key in parsedFiles:
+        del parsedFiles[key]
+    return parsed
+
+
+def _fileDigest(path):
+    """Return the content hash of 'path', as in _ParsedFile.digest."""
+    fin = open(path, 'rb')
+    try:
+        return hashlib.md5(fin.read()).hexdigest()
+    finally:
+        fin.close()
+
+
+class _Substituter(object):
+    """Replaces macro names with their values in emitted text (for the
+    'substitute' and 'include_substitute' options).
+
+    This is a single left-to-right pass over the text: each identifier
+    is looked up in the defines as it is met, so the cost doesn't grow
+    with the number of defines and names are never replaced inside a
+    longer identifier (or a number). Macro names that aren't plain
+    identifiers need a regex alternative of their own, so the matcher is
+    rebuilt when the set of such names changes. With "skipStrings",
+    string and character literals and comments are left alone.
+    """
+    _identRe = re.compile(r"^[a-zA-Z_]\w*$")
+    _matchers = {}  # (odd names, skipStrings) -> compiled regex
+
+    def __init__(self, skipStrings=0):
+        self.skipStrings = skipStrings
+        self._oddNames = None
+        self._re = None
+
+    def invalidate(self, name=None):
+        """Note that macro 'name' (or any, if not given) has been defined
+        or undefined.
+        """
+        if name is None or not self._identRe.match(name):
+            self._re = None
+
+    def _matcher(self, defines):
+        oddNames = frozenset(name for name in defines
+                             if name and not self._identRe.match(name))
+        key = (oddNames, self.skipStrings)
+        try:
+            return self._matchers[key]
+        except KeyError:
+            pass
+        # Tokens that are copied unchanged come first: numbers (so that
+        # the "L" in "10L" is not a macro), and, if skipping them,
+        # literals and comments.
+        keep = [r"\.?[0-9][\w.]*"]
+        if self.skipStrings:
+            keep += [r'"(?:\\.|[^"\\\n])*"', r"'(?:\\.|[^'\\\n])*'",
+                     r"/\*.*?\*/", r"//[^\n]*"]
+        pattern = "(?P<keep>%s)" % "|".join(keep)
+        if oddNames:
+            pattern += "|(?<!\\w)(?:%s)(?!\\w)" % "|".join(
+                re.escape(name) for name in sorted(oddNames, key=len,
+                                                   reverse=True))
+        pattern += r"|[a-zA-Z_]\w*"
+        matcher = self._matchers[key] = re.compile(pattern, re.S)
+        return matcher
+
+    def substitute(self, text, defines, lineNum=None):
+        """Return 'text' with macros replaced. 'lineNum' is the line
+        number of the start of 'text', for __LINE__.
+        """
+        if self._re is None:
+            self._re = self._matcher(defines)
+        get = defines.get
+        pos = [0, lineNum]  # where __LINE__ was last computed
+
+        def replace(match):
+            if match.lastgroup == "keep":
+                return match.group()
+            name = match.group()
+            if name == "__LINE__" and lineNum is not None:
+                pos[1] += text.count("\n", pos[0], match.start())
+                pos[0] = match.start()
+                return str(pos[1])
+            value = get(name, _missing)
+            if value is _missing:
+                return name
+            return str(value)
+        return self._re.sub(replace, text)
+
+
+class _BinarySubstituter(_Substituter):
+    """A _Substituter for the text of files parsed as bytes."""
+    def substitute(self, text, defines, lineNum=None):
+        text = _Substituter.substitute(self, text.decode("latin-1"),
+                                       defines, lineNum)
+        return text.encode("latin-1")
+
+
+class _Run(object):
+    """The options and state of one preprocess() call, shared by the
+    nested processing of #include'd files.
+    """
+    def __init__(self, workspace, keepLines=0, includePath=[],
+                 substitute=0, include_substitute=0,
+                 substituteSkipStrings=0, binary=0, stats=None,
+                 lineMap=None):
+        self.workspace = workspace
+        self.keepLines = keepLines
+        self.includePath = includePath
+        self.substitute = substitute
+        self.include_substitute = include_substitute
+        self.binary = binary
+        if binary:
+            self.parsedFiles = _parsedBinaryFiles
+            self.newline = b"\n"
+        else:
+            self.parsedFiles = _parsedFiles
+            self.newline = "\n"
+        if substitute and binary:
+            self.substituter = _BinarySubstituter(substituteSkipStrings)
+        elif substitute:
+            self.substituter = _Substituter(substituteSkipStrings)
         else:
-            match = None
+            self.substituter = None
+        if include_substitute:
+            self.includeSubstituter = _Substituter()
+        else:
+            self.includeSubstituter = None
+        self.lineMap = lineMap
+        # With "stats" (a PreprocessStats) the phases are timed by
+        # wrappers: there is nothing to skip without it.
+        self.stats = stats
+        self.evaluate = _evaluate
+        self.resolve = self._resolve
+        if stats is not None:
+            self.evaluate = stats._timed("evaluate", stats._evaluate)
+            self.resolve = stats._timed("lookup", self._resolve)
+            if self.substituter is not None:
+                self.substituter.substitute = stats._timed(
+                    "substitute", self.substituter.substitute)
+        # If set (see recordDependencies()), the files read, as
+        # path -> (mtime, size, digest), the #include's resolved, as
+        # (<including dir>, <#include'd name>, <path>), and the include
+        # graph: (<including file>, <line>, <#include'd name>, <path>)
+        # for each #include processed, in order.
+        self.deps = None
+        self.includes = None
+        self.graph = None
+        # The parsed files already found up to date in this run, by
+        # _getParsedFile() key: they aren't stat()'ed again. Runs of one
+        # file for several configurations share it.
+        self.checked = {}
 
-        if match:
-            op = match.group("op")
+    def recordDependencies(self):
+        self.deps = {}
+        self.includes = set()
+        self.graph = []
+
+    def _skipGuardedInclude(self, fname, defines):
+        """Try to handle "#include 'fname'" without reading 'fname',
+        because its include guard is already defined. Returns the output
+        for it if successful, else None.
+        """
+        parsed = self.checked.get(fname)
+        if parsed is None:
+            parsed = self.parsedFiles.get(fname)
+            if parsed is None or parsed.guardMacro not in defines:
+                return None
+            try:
+                st = os.stat(fname)
+            except OSError:
+                return None
+            if parsed.stat != (st.st_mtime_ns, st.st_size):
+                return None
+            self.checked[fname] = parsed
+        elif parsed.guardMacro not in defines:
+            return None
+        if self.deps is not None:
+            self.deps[fname] = parsed.stat + (parsed.digest,)
+        defines['__FILE__'] = fname
+        if self.lineMap is not None:
+            return self._mapGuardedInclude(fname, parsed, defines)
+        output = [self._text(node, defines) for node in parsed.guardPrefix]
+        if self.keepLines:
+            output.append(parsed.guardSkippedKeepLines)
+        else:
+            output.append(parsed.guardSkipped)
+        for node in parsed.guardSuffix:
+            output.append(self._text(node, defines))
+        defines['__LINE__'] = parsed.numLines
+        return self.newline[:0].join(output)
+
+    def _mapGuardedInclude(self, fname, parsed, defines):
+        # _skipGuardedInclude() piece by piece, adding each to the line map.
+        pieces = [(node[1], self._text(node, defines))
+                  for node in parsed.guardPrefix]
+        if self.keepLines:
+            pieces += parsed.guardSkippedKeepLinesPieces
+        else:
+            pieces += parsed.guardSkippedPieces
+        for node in parsed.guardSuffix:
+            pieces.append((node[1], self._text(node, defines)))
+        for lineNum, text in pieces:
+            self.lineMap._add(fname, lineNum, text)
+        defines['__LINE__'] = parsed.numLines
+        return self.newline[:0].join([text for lineNum, text in pieces])
+
+    def _resolve(self, f, fromdir):
+        return _getIncludeIndex(self.workspace).resolve(f, fromdir,
+                                                        self.includePath)
+
+    def _text(self, node, defines):
+        if self.substituter is not None:
+            return self.substituter.substitute(node[2], defines, node[1])
+        return node[2]
+
+    def preprocessFile(self, infile, fout, defines, included=0):
+        """Preprocess 'infile' (a path, or a (path, from, to, last_to_line)
+        tuple for an "#include ... fromto:" region) to stream 'fout'.
+        """
+        chunks = self.iterFile(infile, defines, included)
+        if self.stats is not None:
+            write = self.stats._timed("write", fout.write)
+            chunks = self.stats._timeFile(infile, chunks, included,
+                                          self.newline)
+        else:
+            write = fout.write
+        for chunk in chunks:
+            write(chunk)
+
+    def iterFile(self, infile, defines, included=0, lines=None):
+        """Generate the output of preprocessing 'infile' (see
+        preprocessFile()) in chunks.
+
+        If "lines" is given, the content of 'infile' is read from that
+        iterable of lines as it goes instead of being parsed up front.
+        """
+        if isinstance(infile, tuple):
+            infile, from_, to_, last_to_line = infile
+        else:
+            from_, to_, last_to_line = None, None, None
+        keepLines = self.keepLines
+        substituter = self.substituter
+        newline = self.newline
+        evaluate = self.evaluate
+        stats = self.stats
+        lineMap = self.lineMap
+
+        # Process the input file.
+        # Headers are parsed once and their nodes re-used for every later
+        # #include, only walking the nodes depends on the defines.
+        parsed = None
+        if lines is not None:
+            nodes = _iterNodes(lines)
+        else:
+            if from_ is None:
+                key = infile
+            else:
+                key = (infile, from_, to_, last_to_line)
+            parsed = self.checked.get(key)
+            if parsed is None:
+                parsed = _getParsedFile(infile, from_, to_, last_to_line,
+                                        included or infile in self.parsedFiles,
+                                        self.binary, stats)
+                self.checked[key] = parsed
+            if self.deps is not None:
+                self.deps[infile] = parsed.stat + (parsed.digest,)
+            if stats is not None:
+                stats._addParsedFile(parsed)
+            if parsed.blockError is not None:
+                errmsg, lineNum, line = parsed.blockError
+                raise PreprocessError(errmsg, infile, lineNum, line)
+            # (Setting the state of a list iterator moves it: false
+            # branches are jumped over with parsed.skippedBranch().)
+            nodes = iter(parsed.nodes)
+
+        defines['__FILE__'] = infile
+        SKIP, EMIT = range(2) # states
+        states = [(EMIT,   # a state is (<emit-or-skip-lines-in-this-section>,
+                   0,      #             <have-emitted-in-this-if-block>,
+                   0)]     #             <have-seen-'else'-in-this-if-block>)
+        node = None
+        for node in nodes:
+            op = node[0]
+            if op is None:
+                # A run of plain text lines.
+                try:
+                    if states[-1][0] == EMIT:
+                        if substituter is not None:
+                            text = substituter.substitute(node[2], defines,
+                                                          node[1])
+                        else:
+                            text = node[2]
+                        if lineMap is not None:
+                            lineMap._add(infile, node[1], text)
+                        yield text
+                    else:
+                        if keepLines:
+                            if lineMap is not None:
+                                lineMap._add(infile, node[1],
+                                             newline * node[3])
+                            yield newline * node[3]
+                        if stats is not None:
+                            stats._skipLines(node[3])
+                except IndexError:
+                    raise PreprocessError("superfluous #endif before this line",
+                                          defines['__FILE__'], node[1])
+                continue
+
+            line = node[2]
+            defines['__LINE__'] = node[1]
             if op == "define":
                 if not (states and states[-1][0] == SKIP):
-                    var, val = match.group("var", "val")
+                    var, val = node[3:]
                     if val is None:
                         val = None
                     else:
@@ -158,81 +1633,89 @@ def preprocess(workspace, infile, outfile=sys.stdout, defines={},
                             defines[var] = eval(val) # Deal with value that still need calculation or hex numbers.(exp. #define VAR 2*2 or #define VAR 0x01)
                         except:
                             defines[var] = val
-                fout.write(line) # Keep define lines
+                    if substituter is not None:
+                        substituter.invalidate(var)
+                if lineMap is not None:
+                    lineMap._add(infile, node[1], line)
+                yield line # Keep define lines
             elif op == "undef":
                 if not (states and states[-1][0] == SKIP):
-                    var = match.group("var")
+                    var = node[3]
                     try:
                         del defines[var]
                     except KeyError:
                         pass
+                    if substituter is not None:
+                        substituter.invalidate(var)
             elif op == "include":
                 if not (states and states[-1][0] == SKIP):
-                    if "var" in match.groupdict():
+                    f, var, fromto, part = node[3:]
+                    if var is not None:
                         # This is the second include form: #include VAR
-                        var = match.group("var")
                         f = defines[var]
-                    else:
+                    elif fromto is not None:
                         # This is the first include form: #include "path"
-                        f = match.group("fname")
-                        fromto = part = None
-                        if "fromto" in match.groupdict():
-                            fromto, part = match.group("fromto", "part")
-                            if fromto == 'fromto_':
-                                last_to_line = True
-                            else:
-                                last_to_line = False
-                            try:
-                                from_, to_ = part.split('@')
-                            except ValueError:
-                                raise PreprocessError('Wrong syntax, need #include %s: from-regex@to-regex' % fromto)
-
+                        if fromto == 'fromto_':
+                            last_to_line = True
+                        else:
+                            last_to_line = False
+                        try:
+                            from_, to_ = part.split('@')
+                        except ValueError:
+                            raise PreprocessError('Wrong syntax, need #include %s: from-regex@to-regex' % fromto)
 
                     # HPL modification:
                     # Perform substitutions here such that #include statements
                     # can use defines.
-                    if include_substitute:
-                        for name in reversed(sorted(defines, key=len)):
-                            value = defines[name]
-                            f = f.replace(name, str(value))
-
-                    for root,di,file in os.walk(workspace):
-                        fname = os.path.normpath(os.path.join(root, f))
-                        if os.path.exists(fname):
-                            break
-                    else:
+                    if self.includeSubstituter is not None:
+                        f = self.includeSubstituter.substitute(f, defines)
+
+                    fname = self.resolve(f, os.path.dirname(infile))
+                    if fname is None:
                         raise PreprocessError("could not find #include'd file "\
                                               "\"%s\" on include path: %r"\
-                                              % (f, includePath))
-                    if fromto is not None:
-                        fname = (fname, from_, to_, last_to_line)
-                    defines = preprocess(workspace, fname, fout, defines, force,
-                                         keepLines, includePath,
-                                         substitute, include_substitute)
-                fout.write(line) # Keep define lines
-            elif op in ("if", "ifdef", "ifndef"):
-                if op == "if":
-                    expr = match.group("expr")
-                elif op == "ifdef":
-                    expr = "defined('%s')" % match.group("expr")
-                elif op == "ifndef":
-                    expr = "not defined('%s')" % match.group("expr")
+                                              % (f, self.includePath))
+                    if self.includes is not None:
+                        self.includes.add((os.path.dirname(infile), f, fname))
+                        self.graph.append((infile, node[1], f, fname))
+                    skipped = None
+                    if fromto is None:
+                        skipped = self._skipGuardedInclude(fname, defines)
+                    if skipped is not None:
+                        if stats is not None:
+                            stats._guardSkipped(fname)
+                        yield skipped
+                    else:
+                        if fromto is not None:
+                            fname = (fname, from_, to_, last_to_line)
+                        if stats is None:
+                            yield from self.iterFile(fname, defines, 1)
+                        else:
+                            yield from stats._timeFile(
+                                fname, self.iterFile(fname, defines, 1), 1,
+                                newline)
+                    # __FILE__ is scoped to the file being processed.
+                    defines['__FILE__'] = infile
+                if lineMap is not None:
+                    lineMap._add(infile, node[1], line)
+                yield line # Keep define lines
+            elif op == "if":
                 try:
                     if states and states[-1][0] == SKIP:
                         # Were are nested in a SKIP-portion of an if-block.
                         states.append((SKIP, 0, 0))
                     else:
-                        bol = _evaluate(expr, defines)
+                        bol = evaluate(node[3], defines)
                         if bol:
                             states.append((EMIT, 1, 0))
                         else:
                             states.append((SKIP, 0, 0))
-                except KeyError:
-                    raise PreprocessError("use of undefined variable in "\
-                                          "#%s stmt" % op, defines['__FILE__'],
+                except PreprocessError as ex:
+                    raise PreprocessError("#%s: %s" % (node[4], ex.errmsg),
+                                          defines['__FILE__'],
                                           defines['__LINE__'], line)
             elif op == "elif":
-                expr = match.group("expr")
+                expr = node[3]
                 try:
                     if states[-1][2]: # already had #else in this if-block
                         raise PreprocessError("illegal #elif after #else in "\
@@ -244,7 +1727,12 @@ def preprocess(workspace, infile, outfile=sys.stdout, defines={},
                         # Were are nested in a SKIP-portion of an if-block.
                         states[-1] = (SKIP, 0, 0)
                     else:
-                        bol = _evaluate(expr, defines)
+                        try:
+                            bol = evaluate(expr, defines)
+                        except PreprocessError as ex:
+                            raise PreprocessError("#elif: %s" % ex.errmsg,
+                                                  defines['__FILE__'],
+                                                  defines['__LINE__'], line)
                         if bol:
                             states[-1] = (EMIT, 1, 0)
                         else:
@@ -274,56 +1762,2174 @@ def preprocess(workspace, infile, outfile=sys.stdout, defines={},
                 try:
                     states.pop()
                 except IndexError:
-                    raise PreprocessError("#endif stmt without leading #if"\
+                    raise PreprocessError("#endif stmt without leading #if "\
                                           "stmt", defines['__FILE__'],
                                           defines['__LINE__'], line)
             elif op == "error":
                 if not (states and states[-1][0] == SKIP):
-                    error = match.group("error")
+                    error = node[3]
                     raise PreprocessError("#error: "+error, defines['__FILE__'],
                                           defines['__LINE__'], line)
             if keepLines:
-                fout.write("\n")
+                if lineMap is not None:
+                    lineMap._add(infile, node[1], newline)
+                yield newline
+            if parsed is not None and states[-1][0] == SKIP:
+                # Only an #if/#elif/#else can get here with a false
+                # branch: jump to the next branch of its block.
+                end, skipped, skippedKeepLines, pieces, keepLinesPieces, \
+                    textLines = parsed.skippedBranch(node[1])
+                nodes.__setstate__(end)
+                if keepLines:
+                    skipped, pieces = skippedKeepLines, keepLinesPieces
+                if stats is not None:
+                    stats._skipLines(textLines)
+                if skipped:
+                    if lineMap is not None:
+                        for lineNum, text in pieces:
+                            lineMap._add(infile, lineNum, text)
+                    yield skipped
+        if node is not None and node[0] is None:
+            # Ended with text: the last line of the file.
+            defines['__LINE__'] = node[1] + node[3] - 1
+        if len(states) > 1:
+            raise PreprocessError("unterminated #if block", defines['__FILE__'],
+                                  defines['__LINE__'])
+        elif len(states) < 1:
+            raise PreprocessError("superfluous #endif on or before this line",
+                                  defines['__FILE__'], defines['__LINE__'])
+
+
+#---- module API
+
+class MacroTable(MutableMapping):
+    """A table of defines that can be snapshotted in O(1).
+
+    Entries live in a stack of dicts: writes go to the table's own top
+    dict, the ones below are frozen and may be shared with other tables.
+    snapshot() freezes the top dict and returns a new table sharing all
+    layers, so forking the defines for each file of a workspace run (or
+    for a worker process) costs nothing until one of them is changed.
+    Deletions are recorded as tombstones. Once too many layers have
+    piled up they are merged into one.
+
+    The table also keeps a fingerprint of its contents, updated on each
+    change, that is suitable as a cache key: equal tables have equal
+    fingerprints, whatever order they were built in and in any process.
+    __FILE__ and __LINE__ are left out of it since they only tell where
+    preprocessing currently is.
+    """
+    _maxLayers = 8
+    _positionMacros = ("__FILE__", "__LINE__")
+
+    def __init__(self, defines=None):
+        self._top = {}
+        self._layers = ()       # frozen dicts, newest first
+        self._len = 0
+        self._fingerprint = 0
+        if defines:
+            self.update(defines)
+
+    @staticmethod
+    def _entryHash(name, value):
+        data = repr((name, value)).encode("utf-8")
+        return int(hashlib.md5(data).hexdigest()[:16], 16)
+
+    def __getitem__(self, name):
+        value = self._top.get(name, _missing)
+        if value is _missing:
+            for layer in self._layers:
+                value = layer.get(name, _missing)
+                if value is not _missing:
+                    break
+        if value is _missing or value is _deleted:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        value = self._top.get(name, _missing)
+        if value is _missing:
+            for layer in self._layers:
+                value = layer.get(name, _missing)
+                if value is not _missing:
+                    break
+        if value is _missing or value is _deleted:
+            return default
+        return value
+
+    def __contains__(self, name):
+        return self.get(name, _missing) is not _missing
+
+    def __setitem__(self, name, value):
+        old = self.get(name, _missing)
+        if old is _missing:
+            self._len += 1
+        elif name not in self._positionMacros:
+            self._fingerprint ^= self._entryHash(name, old)
+        if name not in self._positionMacros:
+            self._fingerprint ^= self._entryHash(name, value)
+        self._top[name] = value
+
+    def __delitem__(self, name):
+        old = self.get(name, _missing)
+        if old is _missing:
+            raise KeyError(name)
+        self._len -= 1
+        if name not in self._positionMacros:
+            self._fingerprint ^= self._entryHash(name, old)
+        if self._layers:
+            self._top[name] = _deleted
         else:
+            del self._top[name]
+
+    def __iter__(self):
+        seen = set()
+        for layer in (self._top,) + self._layers:
+            for name, value in layer.items():
+                if name not in seen:
+                    seen.add(name)
+                    if value is not _deleted:
+                        yield name
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return "MacroTable(%r)" % dict(self)
+
+    def __reduce__(self):
+        return (MacroTable, (dict(self),))
+
+    def fingerprint(self):
+        """Return a hash of the defines (other than __FILE__/__LINE__)."""
+        return self._fingerprint
+
+    def snapshot(self):
+        """Return an independent copy of this table, in O(1)."""
+        if self._top:
+            layers = (self._top,) + self._layers
+            if len(layers) > self._maxLayers:
+                merged = {}
+                for layer in reversed(layers):
+                    merged.update(layer)
+                layers = ({name: value for name, value in merged.items()
+                           if value is not _deleted},)
+            self._layers = layers
+            self._top = {}
+        copy = MacroTable.__new__(MacroTable)
+        copy._top = {}
+        copy._layers = self._layers
+        copy._len = self._len
+        copy._fingerprint = self._fingerprint
+        return copy
+    copy = snapshot
+
+    @contextlib.contextmanager
+    def overlay(self):
+        """Context manager giving a scoped copy of this table: changes
+        made to it are dropped at the end of the block.
+
+            with defines.overlay() as scoped:
+                scoped["FOO"] = 1
+                ...
+        """
+        yield self.snapshot()
+
+
+def getConditionCacheStats():
+    """Return a dict with statistics for the cache of #if/#elif results:
+
+        "expressions"   number of distinct expressions compiled
+        "hits"          evaluations answered from the cache
+        "misses"        evaluations that had to be computed
+    """
+    hits = misses = 0
+    for compiled in _compiledExprs.values():
+        hits += compiled.hits
+        misses += compiled.misses
+    return {"expressions": len(_compiledExprs), "hits": hits,
+            "misses": misses}
+
+
+class _StatsFrame(object):
+    # A file being timed by a PreprocessStats.
+    __slots__ = ("path", "childSeconds", "lines", "outputLines",
+                 "childOutputLines", "skippedLines")
+
+    def __init__(self, path):
+        self.path = path
+        self.childSeconds = 0.0     # in the files it #include'd
+        self.lines = 0
+        self.outputLines = 0        # its #include'd files' included
+        self.childOutputLines = 0
+        self.skippedLines = 0
+
+
+class PreprocessStats(object):
+    """Counters and timers of where the time of preprocessing goes.
+
+    Pass one as the "stats" argument of preprocess(), preprocessIter()
+    or preprocessWorkspace() to have it filled in; it adds up over
+    calls. Without one nothing is measured.
+
+    'times' and 'calls' have the seconds spent in, and the number of
+    calls of, each phase:
+
+        "lookup"        resolving #include'd names to paths
+        "read"          reading files (or stat()'ing them when their
+                        parsed form is cached)
+        "parse"         finding the directives in the files read
+        "evaluate"      evaluating #if/#elif expressions
+        "substitute"    substituting macros in the output text
+        "write"         writing the output
+        "store"         the output store and manifest of
+                        preprocessWorkspace()
+
+    'directives' has the number of lines of each directive processed,
+    those in skipped #if branches included. 'conditionCache' has the
+    "hits" and "misses" of the #if/#elif results cache (as counted by
+    getConditionCacheStats(), but per run). 'files' has, for each file
+    processed, a list of:
+
+        [<number of times #include'd>, <how many of those were skipped
+         by its include guard>, <seconds>, <seconds less those of the
+         files it #include'd>]
+
+    where the seconds exclude writing the output (but with
+    preprocessIter() they include the consumer's time). 'counters' has
+    the numbers of files of a preprocessWorkspace() run that were
+    "made", "upToDate" (see its "manifestPath") or "fromStore".
+
+    With "trace", the include tree is recorded too: 'events' has a
+    Chrome trace event (see writeChromeTrace()) for each file processed
+    and each #include skipped by a guard, and 'stacks' has the seconds
+    spent in each chain of #include's (see writeCollapsedStacks()).
+    """
+    phases = ("lookup", "read", "parse", "evaluate", "substitute", "write",
+              "store")
+
+    def __init__(self, trace=False):
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.calls = dict.fromkeys(self.phases, 0)
+        self.directives = {}
+        self.conditionCache = {"hits": 0, "misses": 0}
+        self.files = {}
+        self.counters = {}
+        self.trace = trace
+        self.events = []
+        self.stacks = {}        # "<file>;<#include'd file>;..." -> seconds
+        self._frames = []       # a _StatsFrame for each file being timed
+
+    def _addTime(self, phase, start):
+        now = time.perf_counter()
+        self.times[phase] += now - start
+        self.calls[phase] += 1
+        return now
+
+    def _timed(self, phase, func):
+        times, calls, clock = self.times, self.calls, time.perf_counter
+        def timed(*args):
+            start = clock()
             try:
-                if states[-1][0] == EMIT:
-                    sline = line
-                    if substitute:
-                        for name in reversed(sorted(defines, key=len)):
-                            value = defines[name]
-                            sline = sline.replace(name, str(value))
-                    fout.write(sline)
-                elif keepLines:
-                    fout.write("\n")
-            except IndexError:
-                raise PreprocessError("superfluous #endif before this line",
-                                      defines['__FILE__'],
-                                      defines['__LINE__'])
-    if len(states) > 1:
-        raise PreprocessError("unterminated #if block", defines['__FILE__'],
-                              defines['__LINE__'])
-    elif len(states) < 1:
-        raise PreprocessError("superfluous #endif on or before this line",
-                              defines['__FILE__'], defines['__LINE__'])
-    if fout != outfile:
+                return func(*args)
+            finally:
+                times[phase] += clock() - start
+                calls[phase] += 1
+        return timed
+
+    def _evaluate(self, expr, defines):
+        # _evaluate(), counting whether the result was cached.
+        compiled = _compileExpression(expr)
+        hits = compiled.hits
+        try:
+            return compiled.evaluate(defines)
+        finally:
+            if compiled.hits != hits:
+                self.conditionCache["hits"] += 1
+            else:
+                self.conditionCache["misses"] += 1
+
+    def _count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def _addParsedFile(self, parsed):
+        directives = self.directives
+        for op, count in parsed.directiveCounts().items():
+            directives[op] = directives.get(op, 0) + count
+        if self._frames:
+            self._frames[-1].lines = parsed.numLines
+
+    def _skipLines(self, count):
+        if self._frames:
+            self._frames[-1].skippedLines += count
+
+    def _fileEntry(self, path):
+        if isinstance(path, tuple):     # a fromto region
+            path = path[0]
+        try:
+            return self.files[path]
+        except KeyError:
+            entry = self.files[path] = [0, 0, 0.0, 0.0]
+            return entry
+
+    def _guardSkipped(self, path):
+        entry = self._fileEntry(path)
+        entry[0] += 1
+        entry[1] += 1
+        if self.trace:
+            self.events.append({"name": path, "ph": "i", "s": "t",
+                                "ts": time.perf_counter() * 1e6,
+                                "pid": os.getpid(), "tid": 0,
+                                "args": {"depth": len(self._frames),
+                                         "guardSkipped": True}})
+
+    def _timeFile(self, path, chunks, included=0, newline="\n"):
+        # Time the generator 'chunks' of the output of 'path'.
+        entry = self._fileEntry(path)
+        if included:
+            entry[0] += 1
+        if isinstance(path, tuple):     # a fromto region
+            path = path[0]
+        times, frames = self.times, self._frames
+        frame = _StatsFrame(path)
+        frames.append(frame)
+        wallStart = time.perf_counter()
+        start = wallStart - times["write"]
+        try:
+            if self.trace:
+                # The chunks of #include'd files go through here too.
+                for chunk in chunks:
+                    frame.outputLines += chunk.count(newline)
+                    yield chunk
+            else:
+                yield from chunks
+        finally:
+            end = time.perf_counter()
+            elapsed = end - times["write"] - start
+            frames.pop()
+            entry[2] += elapsed
+            entry[3] += elapsed - frame.childSeconds
+            if frames:
+                frames[-1].childSeconds += elapsed
+                frames[-1].childOutputLines += frame.outputLines
+            if self.trace:
+                self._traceFile(frame, wallStart, end, elapsed)
+
+    def _traceFile(self, frame, start, end, elapsed):
+        frames = self._frames
+        stack = ";".join([f.path for f in frames] + [frame.path])
+        self.stacks[stack] = self.stacks.get(stack, 0.0) \
+                             + elapsed - frame.childSeconds
+        self.events.append({
+            "name": frame.path, "ph": "X", "ts": start * 1e6,
+            "dur": (end - start) * 1e6, "pid": os.getpid(), "tid": 0,
+            "args": {"depth": len(frames), "lines": frame.lines,
+                     "outputLines": frame.outputLines
+                                    - frame.childOutputLines,
+                     "skippedLines": frame.skippedLines}})
+
+    def writeChromeTrace(self, fout):
+        """Write the trace 'events' to stream 'fout' in the Chrome trace
+        event format (for chrome://tracing, Perfetto or speedscope).
+
+        Each file processed is a complete event lasting from its first
+        line to its last, nested in the event of the file #include'ing
+        it. Its "args" have its "depth" in the include tree, its number
+        of "lines", of "outputLines" written for it (with "keepLines",
+        the blank ones too) and of text "skippedLines" in false #if
+        branches. #include's skipped by their guard are instant events.
+        Unlike the other times, these include writing the output.
+        """
+        fout.write(json.dumps({"traceEvents": self.events,
+                               "displayTimeUnit": "ms"}))
+
+    def writeCollapsedStacks(self, fout):
+        """Write the 'stacks' to stream 'fout' in the collapsed stack
+        format of flamegraph.pl: a line per chain of #include's with its
+        (self) time in microseconds.
+        """
+        for stack, seconds in sorted(self.stacks.items()):
+            fout.write("%s %d\n" % (stack, round(seconds * 1e6)))
+
+    def merge(self, other):
+        """Add the counts and times of PreprocessStats 'other'."""
+        for phase in self.phases:
+            self.times[phase] += other.times[phase]
+            self.calls[phase] += other.calls[phase]
+        for op, count in other.directives.items():
+            self.directives[op] = self.directives.get(op, 0) + count
+        for key, count in other.conditionCache.items():
+            self.conditionCache[key] += count
+        for counter, count in other.counters.items():
+            self._count(counter, count)
+        for path, otherEntry in other.files.items():
+            entry = self._fileEntry(path)
+            for i, value in enumerate(otherEntry):
+                entry[i] += value
+        self.events += other.events
+        for stack, seconds in other.stacks.items():
+            self.stacks[stack] = self.stacks.get(stack, 0.0) + seconds
+
+    def report(self, fout=sys.stdout, top=10):
+        """Write a report of the stats to stream 'fout', with the "top"
+        #include'd files that took the most time.
+        """
+        fout.write("%-12s %10s %10s\n" % ("phase", "calls", "seconds"))
+        for phase in self.phases:
+            fout.write("%-12s %10d %10.3f\n" % (phase, self.calls[phase],
+                                                self.times[phase]))
+        if self.directives:
+            fout.write("\ndirectives: %s\n" % ", ".join(
+                "%s %d" % (op, count)
+                for op, count in sorted(self.directives.items())))
+        if self.calls["evaluate"]:
+            fout.write("#if cache: hits %d, misses %d\n"
+                       % (self.conditionCache["hits"],
+                          self.conditionCache["misses"]))
+        if self.counters:
+            fout.write("files: %s\n" % ", ".join(
+                "%s %d" % (counter, count)
+                for counter, count in sorted(self.counters.items())))
+        headers = sorted([(entry[2], path)
+                          for path, entry in self.files.items() if entry[0]],
+                         reverse=True)[:top]
+        if headers:
+            fout.write("\n%10s %10s %9s %9s  %s\n" % (
+                "seconds", "self", "included", "guarded", "header"))
+            for seconds, path in headers:
+                included, guarded, seconds, selfSeconds = self.files[path]
+                fout.write("%10.3f %10.3f %9d %9d  %s\n" % (
+                    seconds, selfSeconds, included, guarded, path))
+
+
+class LineMap(object):
+    """Where each line of a preprocessed output comes from, for tools
+    that need the source lines without the blank lines of "keepLines".
+
+    Pass one as the "lineMap" argument of preprocess() or
+    preprocessIter() to have it filled in as the output is written
+    (use one per output). 'files' has the source files' paths and
+    'entries' has, for each run of output lines that are consecutive
+    lines of one file, an (<output line>, <index in 'files'>, <source
+    line>) tuple: output line N of the run, from its first, is source
+    line <source line> + N. 'numLines' is the number of output lines.
+    Lines are numbered from 1.
+
+    write() saves it as JSON, load() reads it back.
+    """
+    _version = 1
+
+    def __init__(self):
+        self.files = []
+        self.entries = []
+        self.numLines = 0
+        self._fileIndex = {}
+        self._starts = []       # the entries' output lines, for bisect
+        self._atLineStart = True
+
+    def _add(self, path, line, chunk):
+        # 'chunk' of output is source 'path' from line 'line' on.
+        if not chunk:
+            return
+        newline = isinstance(chunk, str) and "\n" or b"\n"
+        count = chunk.count(newline)
+        if not chunk.endswith(newline):
+            count += 1          # and the output line stays open
+        if not self._atLineStart:
+            # The first line ends one from a file with no last newline.
+            count -= 1
+            line += 1
+        if count:
+            self._map(self.numLines + 1, path, line)
+            self.numLines += count
+        self._atLineStart = chunk.endswith(newline)
+
+    def _map(self, start, path, line):
+        index = self._fileIndex.get(path)
+        if index is None:
+            index = self._fileIndex[path] = len(self.files)
+            self.files.append(path)
+        if self.entries:
+            o, f, l = self.entries[-1]
+            if f == index and l + start - o == line:
+                return          # the same run goes on
+        self.entries.append((start, index, line))
+        self._starts.append(start)
+
+    def lookup(self, line):
+        """Return the (<source path>, <source line>) of output line
+        'line', or None if there is no such line.
+        """
+        if not 1 <= line <= self.numLines:
+            return None
+        o, f, l = self.entries[bisect.bisect_right(self._starts, line) - 1]
+        return self.files[f], l + line - o
+
+    def write(self, fout):
+        """Write the map to text stream 'fout' as JSON:
+
+            {"version": 1, "files": [<path>, ...], "lines": <numLines>,
+             "map": [<output line>, <file index>, <source line>, ...]}
+
+        with 'entries' flattened in "map".
+        """
+        flat = []
+        for entry in self.entries:
+            flat.extend(entry)
+        fout.write(json.dumps({"version": self._version,
+                               "files": self.files, "lines": self.numLines,
+                               "map": flat}))
+
+    @classmethod
+    def load(cls, fin):
+        """Read a map written by write() from text stream 'fin'."""
+        data = json.load(fin)
+        if not isinstance(data, dict) or data.get("version") != cls._version:
+            raise PreprocessError("unknown line map format")
+        lineMap = cls()
+        lineMap.files = data["files"]
+        lineMap._fileIndex = dict((path, i)
+                                  for i, path in enumerate(lineMap.files))
+        flat = data["map"]
+        lineMap.entries = [tuple(flat[i:i+3]) for i in range(0, len(flat), 3)]
+        lineMap._starts = [entry[0] for entry in lineMap.entries]
+        lineMap.numLines = data["lines"]
+        return lineMap
+
+
+def _sameContent(path1, path2):
+    try:
+        if os.path.getsize(path1) != os.path.getsize(path2):
+            return False
+        fin1 = open(path1, 'rb')
+        fin2 = open(path2, 'rb')
+    except OSError:
+        return False
+    try:
+        while True:
+            chunk = fin1.read(65536)
+            if chunk != fin2.read(65536):
+                return False
+            if not chunk:
+                return True
+    finally:
+        fin1.close()
+        fin2.close()
+
+
+def _updateOutput(tmpPath, outfile, force):
+    """Move the new output 'tmpPath' to 'outfile', unless it has the
+    same content: an untouched output keeps its mtime, so tools
+    watching the outputs don't redo their work. Returns true if
+    'outfile' was written.
+    """
+    if _sameContent(tmpPath, outfile):
+        os.remove(tmpPath)
+        return False
+    if force and os.path.exists(outfile):
+        os.chmod(outfile, 0o777)
+    os.replace(tmpPath, outfile)
+    return True
+
+
+def _tempPath(path):
+    return "%s.%d.tmp" % (path, os.getpid())
+
+
+def preprocess(workspace, infile, outfile=sys.stdout, defines={},
+               force=0, keepLines=0, includePath=[],
+               substitute=0, include_substitute=0, substituteSkipStrings=0,
+               binary=0, stats=None, lineMap=None):
+    """Preprocess 'infile' (a file in 'workspace') to 'outfile' (a path
+    or a stream) with the given "defines", and return the defines as
+    they are at the end of the file.
+
+    With "substitute", macro names in the output text are replaced with
+    their values ("substituteSkipStrings" keeps string literals and
+    comments as is); "include_substitute" does the same for the paths
+    of #include's.
+
+    With "binary", files are read as bytes (memory-mapped) and never
+    decoded: the text goes to the output as is, so a stream 'outfile'
+    must be a binary one. Directives are read as Latin-1.
+
+    "stats", a PreprocessStats, is filled in with where the time goes,
+    and "lineMap", a LineMap, with where each output line comes from.
+
+    Files created or removed since the last call are taken into account.
+    """
+    # Once per call: the #include's of the run are then resolved from
+    # memory.
+    _refreshIncludeIndex(workspace)
+    run = _Run(workspace, keepLines, includePath, substitute,
+               include_substitute, substituteSkipStrings, binary, stats,
+               lineMap)
+    return _preprocessTo(run, infile, outfile, defines, force)
+
+
+def _preprocessTo(run, infile, outfile, defines, force):
+    """Preprocess 'infile' to 'outfile' with the _Run 'run', see
+    preprocess().
+    """
+    if not isinstance(outfile, (str, bytes)):
+        run.preprocessFile(infile, outfile, defines)
+        return defines
+    # Written aside and moved in place, see _updateOutput().
+    outfile = os.fsdecode(outfile)
+    tmpPath = _tempPath(outfile)
+    fout = open(tmpPath, run.binary and 'wb' or 'w')
+    try:
+        run.preprocessFile(infile, fout, defines)
+    finally:
         fout.close()
-    
+        _updateOutput(tmpPath, outfile, force)
     return defines
 
 
+def preprocessIter(workspace, infile, defines=None, keepLines=0,
+                   includePath=[], substitute=0, include_substitute=0,
+                   substituteSkipStrings=0, chunkSize=65536, binary=0,
+                   stats=None, lineMap=None):
+    """Generate the output of preprocessing 'infile' (a file in
+    'workspace', or a stream) in chunks of about "chunkSize"
+    characters; the options are as for preprocess(). With "binary" the
+    chunks are bytes and a stream 'infile' must be a binary one.
+
+    'infile' is read as the output is consumed, so memory use doesn't
+    grow with its size: this is for piping huge files (e.g. generated
+    amalgamations) somewhere without an intermediate file. #include'd
+    files are read and cached as for preprocess(). "defines" (if given)
+    is updated as the output is generated, and so is "lineMap".
+    """
+    if defines is None:
+        defines = {}
+    _refreshIncludeIndex(workspace)
+    run = _Run(workspace, keepLines, includePath, substitute,
+               include_substitute, substituteSkipStrings, binary, stats,
+               lineMap)
+    join = run.newline[:0].join
+    if isinstance(infile, (str, bytes)):
+        path = os.fsdecode(infile)
+        fin = open(path, binary and 'rb' or 'r')
+    else:
+        fin = infile
+        path = getattr(fin, "name", None)
+        if not isinstance(path, str):
+            path = os.path.join(workspace, "<stream>")
+    try:
+        output = run.iterFile(path, defines, lines=fin)
+        if stats is not None:
+            output = stats._timeFile(path, output, newline=run.newline)
+        chunks, size = [], 0
+        for chunk in output:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= chunkSize:
+                yield join(chunks)
+                chunks, size = [], 0
+        if chunks:
+            yield join(chunks)
+    finally:
+        if fin is not infile:
+            fin.close()
+
+
+class _Manifest(object):
+    """What each output of a preprocessWorkspace() run was made from,
+    kept in a file between runs so that a re-run only preprocesses the
+    files whose inputs changed.
+
+    An entry records every file read for the output (the input and all
+    it #include'd) with its mtime, size and content hash, and how each
+    #include was resolved, since a new header can change that, and the
+    include graph (see _Run.graph). The starting defines and options are
+    recorded for the whole run: if they change no entry is re-used. With
+    no 'path' it is only kept in memory.
+    """
+    _version = 2
+
+    def __init__(self, path, defines, options=()):
+        self.path = path
+        self.fingerprint = defines.fingerprint()
+        self.options = sorted(options)
+        self.entries = {}
+        if path is None:
+            return
+        try:
+            fin = open(path, 'r')
+            try:
+                data = json.load(fin)
+            finally:
+                fin.close()
+        except (EnvironmentError, ValueError):
+            return
+        if isinstance(data, dict) and data.get("version") == self._version \
+           and data.get("fingerprint") == self.fingerprint \
+           and data.get("options") == self.options:
+            self.entries = data["outputs"]
+
+    def isUpToDate(self, infile, outfile, index, statCache=None):
+        """Return true if 'outfile' made from 'infile' is up to date.
+
+        "statCache" is a dict of path -> os.stat() result (None if it
+        failed) to share between the calls of a pass, so that a header
+        #include'd by many files is only stat()'ed once.
+        """
+        if statCache is None:
+            statCache = {}
+        entry = self.entries.get(infile)
+        if entry is None or entry["outfile"] != outfile \
+           or not os.path.exists(outfile):
+            return False
+        if "lineMap" in self.options \
+           and not os.path.exists(_lineMapPath(outfile)):
+            return False
+        for path, dep in entry["deps"].items():
+            try:
+                st = statCache[path]
+            except KeyError:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    st = None
+                statCache[path] = st
+            if st is None:
+                return False
+            if dep[0] != st.st_mtime_ns or dep[1] != st.st_size:
+                # Touched, but maybe not changed.
+                if dep[1] != st.st_size or _fileDigest(path) != dep[2]:
+                    return False
+                if st.st_mtime_ns < (time.time() - 2) * 1e9:
+                    dep[0] = st.st_mtime_ns
+        for fromdir, f, fname in entry["includes"]:
+            if index.resolve(f, fromdir) != fname:
+                return False
+        return True
+
+    def update(self, infile, outfile, deps, includes, graph):
+        # A file changed within the same mtime tick as it was read would
+        # look unchanged next time: always check the content of those.
+        horizon = (time.time() - 2) * 1e9
+        recorded = {}
+        for path, (mtime, size, digest) in deps.items():
+            if mtime > horizon:
+                mtime = None
+            recorded[path] = [mtime, size, digest]
+        self.entries[infile] = {"outfile": outfile, "deps": recorded,
+                                "includes": [list(i) for i in includes],
+                                "graph": [list(edge) for edge in graph]}
+
+    def discard(self, infile):
+        self.entries.pop(infile, None)
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {"version": self._version, "fingerprint": self.fingerprint,
+                "options": self.options, "outputs": self.entries}
+        tmpPath = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            manifestDir = os.path.dirname(self.path)
+            if manifestDir and not os.path.isdir(manifestDir):
+                os.makedirs(manifestDir)
+            fout = open(tmpPath, 'w')
+            try:
+                # (json.dump() would use the slow, pure Python encoder.)
+                fout.write(json.dumps(data, sort_keys=True))
+            finally:
+                fout.close()
+            os.replace(tmpPath, self.path)
+        except (OSError, IOError):
+            # Without a manifest the next run just does everything.
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+
+def _workspaceFiles(index, outdir):
+    """Generate (infile, outfile) for each file of the workspace to
+    preprocess, in a stable order.
+    """
+    for dirpath, names in index.walk():
+        reldir = dirpath[len(index.workspace)+1:]
+        for name in names:
+            # Only take .c and .h as target.
+            if name[-2:] in [".c", ".h"]:
+                yield (os.path.join(dirpath, name),
+                       os.path.join(outdir, reldir, name))
+
+
+class _OutputCache(object):
+    """A store of preprocessed outputs in directory 'path', shared by
+    workspace runs.
+
+    Outputs are stored by the hash of their content. They are looked up
+    by a key made of the input file (its path and content hash) and the
+    starting defines; the include closure can only be known by going
+    through the file, so the index keeps the last few closures seen for
+    a key (the files read with their content hashes, how the #include's
+    resolved and the include graph) with the output made from each, and
+    its line map if asked for. A closure that still matches the
+    workspace gives the output without preprocessing. Unlike the
+    manifest, this survives switching back and forth between defines or
+    between versions of a file.
+    """
+    _maxClosures = 8
+
+    def __init__(self, path):
+        self.path = path
+        self._digests = {}      # path -> ((mtime, size), digest)
+
+    def _digest(self, path):
+        st = os.stat(path)
+        stat = (st.st_mtime_ns, st.st_size)
+        known = self._digests.get(path)
+        if known is not None and known[0] == stat:
+            return known[1]
+        digest = _fileDigest(path)
+        self._digests[path] = (stat, digest)
+        return digest
+
+    def _indexPath(self, key):
+        return os.path.join(self.path, "index", key[:2], key)
+
+    def _objectPath(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], digest)
+
+    def _loadClosures(self, key):
+        try:
+            fin = open(self._indexPath(key), 'r')
+            try:
+                return json.load(fin)
+            finally:
+                fin.close()
+        except (EnvironmentError, ValueError):
+            return []
+
+    def _write(self, path, write):
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                if not os.path.isdir(dirname):  # lost a race with a worker
+                    raise
+        tmpPath = _tempPath(path)
+        try:
+            write(tmpPath)
+            os.replace(tmpPath, path)
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+    def key(self, infile, defines, binary=0, lineMap=0):
+        fields = (infile, self._digest(infile), defines.fingerprint(),
+                  bool(binary))
+        if lineMap:
+            fields += ("lineMap",)
+        return hashlib.md5(repr(fields).encode("utf-8")).hexdigest()
+
+    def lookup(self, key, index):
+        """Return the closure for 'key' that matches the workspace as it
+        is now, or None.
+        """
+        for closure in self._loadClosures(key):
+            if "graph" not in closure:
+                continue    # stored by an older version
+            try:
+                for path, digest in closure["deps"].items():
+                    if self._digest(path) != digest:
+                        break
+                else:
+                    for fromdir, f, fname in closure["includes"]:
+                        if index.resolve(f, fromdir) != fname:
+                            break
+                    else:
+                        objects = [closure["output"]]
+                        if "lineMap" in closure:
+                            objects.append(closure["lineMap"])
+                        if all(os.path.exists(self._objectPath(digest))
+                               for digest in objects):
+                            return closure
+            except OSError:
+                pass
+        return None
+
+    def restore(self, closure, outfile):
+        """Make 'outfile' (and its line map, if stored) from the output
+        of 'closure' (see lookup()). Returns the dependencies and include
+        graph as recorded by _Run.
+        """
+        tmpPath = _tempPath(outfile)
+        shutil.copyfile(self._objectPath(closure["output"]), tmpPath)
+        _updateOutput(tmpPath, outfile, 1)
+        if "lineMap" in closure:
+            mapPath = _lineMapPath(outfile)
+            tmpPath = _tempPath(mapPath)
+            shutil.copyfile(self._objectPath(closure["lineMap"]), tmpPath)
+            _updateOutput(tmpPath, mapPath, 1)
+        deps = {}
+        for path, digest in closure["deps"].items():
+            deps[path] = self._digests[path][0] + (digest,)
+        return (deps, [tuple(include) for include in closure["includes"]],
+                [tuple(edge) for edge in closure["graph"]])
+
+    def _storeObject(self, tmpPath):
+        digest = _fileDigest(tmpPath)
+        objectPath = self._objectPath(digest)
+        if not os.path.exists(objectPath):
+            self._write(objectPath,
+                        lambda path: shutil.copyfile(tmpPath, path))
+        return digest
+
+    def store(self, key, tmpPath, deps, includes, graph, lineMapPath=None):
+        """Add the output 'tmpPath' (and its line map 'lineMapPath')
+        made with the given dependencies and include graph (as recorded
+        by _Run) under 'key'.
+        """
+        for path, (mtime, size, digest) in deps.items():
+            self._digests[path] = ((mtime, size), digest)
+        closure = {"deps": dict((path, dep[2]) for path, dep in deps.items()),
+                   "includes": [list(include) for include in includes],
+                   "graph": [list(edge) for edge in graph],
+                   "output": self._storeObject(tmpPath)}
+        if lineMapPath is not None:
+            closure["lineMap"] = self._storeObject(lineMapPath)
+        closures = [closure] + [c for c in self._loadClosures(key)
+                                if c["deps"] != closure["deps"]
+                                or c["includes"] != closure["includes"]]
+        def write(path):
+            fout = open(path, 'w')
+            try:
+                fout.write(json.dumps(closures[:self._maxClosures]))
+            finally:
+                fout.close()
+        self._write(self._indexPath(key), write)
+
+
+_workerDefines = None    # starting defines of each configuration of a
+                         # preprocessWorkspace() run
+_workerCache = None      # and its _OutputCache
+_workerStats = None      # if not None, return PreprocessStats(_workerStats)
+                         # for each file
+
+def _initWorker(workspace, index, defines, cache=None, stats=None):
+    # Pool workers get the parent's include index instead of
+    # rebuilding it, and the starting defines once instead of per file.
+    global _workerDefines, _workerCache, _workerStats
+    _includeIndexes[workspace] = index
+    _workerDefines = defines
+    _workerCache = cache
+    _workerStats = stats
+
+
+def _makeWorkspaceFile(workspace, infile, outfile, defines, binary,
+                       lineMap=0, stats=None, checked=None):
+    # Returns the dependencies of the output, see _preprocessWorkspaceFile().
+    cache = _workerCache
+    if cache is not None:
+        if stats is not None:
+            start = time.perf_counter()
+        key = cache.key(infile, defines, binary, lineMap)
+        closure = cache.lookup(key, _includeIndexes[workspace])
+        if closure is not None:
+            deps = cache.restore(closure, outfile)
+            if stats is not None:
+                stats._addTime("store", start)
+                stats._count("fromStore")
+            return deps
+        if stats is not None:
+            stats._addTime("store", start)
+    if stats is not None:
+        stats._count("made")
+    run = _Run(workspace, binary=binary, stats=stats,
+               lineMap=lineMap and LineMap() or None)
+    if checked is not None:
+        run.checked = checked
+    run.recordDependencies()
+    tmpPath = _tempPath(outfile)
+    fout = open(tmpPath, binary and 'wb' or 'w')
+    try:
+        run.preprocessFile(infile, fout, defines.snapshot())
+    except:
+        fout.close()
+        _updateOutput(tmpPath, outfile, 1)
+        raise
+    fout.close()
+    mapPath = mapTmpPath = None
+    if lineMap:
+        mapPath = _lineMapPath(outfile)
+        mapTmpPath = _tempPath(mapPath)
+        fout = open(mapTmpPath, 'w')
+        try:
+            run.lineMap.write(fout)
+        finally:
+            fout.close()
+    includes = sorted(run.includes)
+    if cache is not None:
+        if stats is not None:
+            start = time.perf_counter()
+        try:
+            cache.store(key, tmpPath, run.deps, includes, run.graph,
+                        mapTmpPath)
+        except EnvironmentError:
+            pass    # the cache is only an optimization
+        if stats is not None:
+            stats._addTime("store", start)
+    _updateOutput(tmpPath, outfile, 1)
+    if lineMap:
+        _updateOutput(mapTmpPath, mapPath, 1)
+    return run.deps, includes, run.graph
+
+
+def _preprocessWorkspaceFile(args):
+    """Preprocess one file of a workspace run to its 'outfiles', one per
+    configuration (None where it is up to date), see
+    preprocessWorkspace(). Returns (infile, <results>, <PreprocessStats
+    or None>), with for each of 'outfiles' None or (outfile, <error
+    message or None>, <dependencies>), the dependencies being the files
+    read, the #include's resolved and the include graph (see _Run.deps,
+    _Run.includes and _Run.graph).
+    """
+    workspace, infile, outfiles, binary, lineMap = args
+    stats = None
+    if _workerStats is not None:
+        stats = PreprocessStats(_workerStats)
+    # The files read for one configuration are parsed and checked only
+    # once for all of them, see _Run.checked.
+    checked = {}
+    results = []
+    for outfile, defines in zip(outfiles, _workerDefines):
+        if outfile is None:
+            results.append(None)
+            continue
+        try:
+            outdir = os.path.dirname(outfile)
+            if outdir and not os.path.isdir(outdir):
+                try:
+                    os.makedirs(outdir)
+                except OSError:
+                    if not os.path.isdir(outdir):  # lost a race with a worker
+                        raise
+            deps = _makeWorkspaceFile(workspace, infile, outfile, defines,
+                                      binary, lineMap, stats, checked)
+        except (PreprocessError, EnvironmentError) as ex:
+            results.append((outfile, str(ex), None))
+        except Exception as ex:
+            results.append((outfile, "%s: %s: %s" % (
+                infile, ex.__class__.__name__, ex), None))
+        else:
+            results.append((outfile, None, deps))
+    return infile, results, stats
+
+
+def _collectResults(results, errfile, manifests, names, stats=None):
+    # 'manifests' and 'names' are those of the configurations, a name
+    # being None if there is only one.
+    failures = []
+    for infile, fileResults, fileStats in results:
+        if fileStats is not None:
+            stats.merge(fileStats)
+        for result, manifest, name in zip(fileResults, manifests, names):
+            if result is None:
+                continue
+            outfile, error, deps = result
+            if error is not None:
+                if name is not None:
+                    error = "[%s] %s" % (name, error)
+                failures.append((infile, error))
+                if errfile is not None:
+                    errfile.write("preprocess: error: %s\n" % error)
+                if manifest is not None:
+                    manifest.discard(infile)
+            elif manifest is not None:
+                manifest.update(infile, outfile, *deps)
+    return failures
+
+
+def preprocessWorkspace(workspace, outdir, defines={}, jobs=1,
+                        indexPath=None, errfile=sys.stderr,
+                        manifestPath=None, cacheDir=None, binary=0,
+                        stats=None, includeGraphPath=None, lineMap=0,
+                        configurations=None):
+    """Preprocess every .c and .h file under 'workspace' to the same
+    relative path under 'outdir'.
+
+    Each file starts from its own snapshot of "defines" (a dict or a
+    MacroTable), so files are independent of each other and can be
+    spread over a pool of "jobs" worker processes. A failing file
+    doesn't stop the others; errors are written to "errfile" in file
+    order whatever the number of jobs.
+    "indexPath" is where to persist the include index between runs.
+    With "manifestPath", what each output depends on is kept there and
+    outputs whose dependencies haven't changed since the last run are
+    not made again.
+    With "cacheDir", outputs are also kept in a store there and taken
+    from it when a file is preprocessed again with the same inputs. An
+    output file is only rewritten if its content changes. "binary" and
+    "stats" are as for preprocess().
+
+    With "includeGraphPath", the #include's processed for each file are
+    written there (see _writeIncludeGraph()), including for the files
+    that were up to date. With "lineMap", each output gets a LineMap of
+    where its lines come from, written next to it with a ".linemap"
+    extension.
+
+    With "configurations", a dict {<name>: <defines>}, the workspace is
+    preprocessed for each configuration in the same pass, each file
+    starting from "defines" updated with those of the configuration. A
+    file is read and parsed once, then walked once per configuration to
+    its output under os.path.join(outdir, <name>). Each configuration
+    has its own manifest and include graph, at "manifestPath" and
+    "includeGraphPath" with "." and its name appended. Error messages
+    start with "[<name>] ".
+
+    Returns the list of (infile, <error message>) for failed files.
+    """
+    workspace = os.path.normpath(workspace)
+    # Rescanned for each run: files may have come and gone since the last.
+    index = _includeIndexes[workspace] = _IncludeIndex(workspace, indexPath)
+    if not isinstance(defines, MacroTable):
+        defines = MacroTable(defines)
+    cache = None
+    if cacheDir is not None:
+        cache = _OutputCache(cacheDir)
+    if configurations is None:
+        configs = [(None, outdir, defines)]
+    else:
+        configs = []
+        for name, overrides in configurations.items():
+            configDefines = defines.snapshot()
+            configDefines.update(overrides)
+            configs.append((name, os.path.join(outdir, name), configDefines))
+    names = [name for name, configOutdir, configDefines in configs]
+    manifests = []
+    for name, configOutdir, configDefines in configs:
+        manifest = None
+        if manifestPath is not None or includeGraphPath is not None:
+            # (The include graph is gathered from the manifest entries.)
+            manifest = _Manifest(_configurationPath(manifestPath, name),
+                                 configDefines,
+                                 _workspaceOptions(binary, lineMap))
+        manifests.append(manifest)
+    if stats is not None:
+        start = time.perf_counter()
+    tasks = []
+    files = []
+    upToDate = 0
+    statCache = {}
+    for infile, relpath in _workspaceFiles(index, ""):
+        files.append(infile)
+        outfiles = []
+        for (name, configOutdir, configDefines), manifest \
+                in zip(configs, manifests):
+            outfile = os.path.join(configOutdir, relpath)
+            if manifest is not None \
+               and manifest.isUpToDate(infile, outfile, index, statCache):
+                outfile = None
+                upToDate += 1
+            outfiles.append(outfile)
+        if len(outfiles) > outfiles.count(None):
+            tasks.append((workspace, infile, outfiles, binary, lineMap))
+    for manifest in manifests:
+        if manifest is not None:
+            for infile in set(manifest.entries) - set(files):
+                manifest.discard(infile)
+    if stats is not None:
+        stats._addTime("store", start)
+        stats._count("upToDate", upToDate)
+    failures = _runWorkspaceTasks(
+        tasks, jobs, index, [configDefines for name, configOutdir,
+                             configDefines in configs],
+        cache, manifests, errfile, stats, names)
+    if includeGraphPath is not None:
+        for name, manifest in zip(names, manifests):
+            _writeIncludeGraph(_configurationPath(includeGraphPath, name),
+                               files, manifest.entries)
+    return failures
+
+
+def _configurationPath(path, name):
+    """Return where the file at 'path' of a preprocessWorkspace() run
+    (its manifest or include graph) is for the configuration 'name'.
+    """
+    if path is None or name is None:
+        return path
+    return "%s.%s" % (path, name)
+
+
+def _workspaceOptions(binary, lineMap):
+    # The options of a workspace run that its outputs depend on.
+    options = []
+    if binary:
+        options.append("binary")
+    if lineMap:
+        options.append("lineMap")
+    return options
+
+
+def _lineMapPath(outfile):
+    return outfile + ".linemap"
+
+
+def _writeIncludeGraph(path, files, entries):
+    """Write the include graph of the 'files' of a workspace run, from
+    their manifest 'entries', to 'path' as JSON lines: for each file
+    made, in order,
+
+        {"file": <path>, "includes": [[<including file>, <line>,
+                                       <#include'd name>, <path>], ...]}
+
+    the #include's being those processed (i.e. not in a false #if
+    branch), in order, those of #include'd files included.
+    """
+    tmpPath = _tempPath(path)
+    fout = open(tmpPath, 'w')
+    try:
+        for infile in files:
+            entry = entries.get(infile)
+            if entry is not None:
+                fout.write(json.dumps({"file": infile,
+                                       "includes": entry["graph"]}))
+                fout.write("\n")
+    finally:
+        fout.close()
+    os.replace(tmpPath, path)
+
+
+def _runWorkspaceTasks(tasks, jobs, index, defines, cache, manifests,
+                       errfile, stats=None, names=None):
+    # Make the outputs for the _preprocessWorkspaceFile() 'tasks';
+    # 'defines', 'manifests' and 'names' have one item per configuration.
+    workspace = index.workspace
+    if names is None:
+        names = [None] * len(defines)
+    initArgs = (workspace, index, defines, cache, None)
+    if stats is not None:
+        initArgs = (workspace, index, defines, cache, stats.trace)
+    try:
+        if jobs > 1 and len(tasks) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs, _initWorker, initArgs)
+            try:
+                chunksize = max(1, min(64, len(tasks) // (jobs * 8)))
+                results = pool.imap(_preprocessWorkspaceFile, tasks,
+                                    chunksize)
+                failures = _collectResults(results, errfile, manifests, names,
+                                           stats)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _initWorker(*initArgs)
+            failures = _collectResults(map(_preprocessWorkspaceFile, tasks),
+                                       errfile, manifests, names, stats)
+    finally:
+        if stats is not None:
+            start = time.perf_counter()
+        for manifest in manifests:
+            if manifest is not None:
+                manifest.save()
+        if stats is not None:
+            stats._addTime("store", start)
+    return failures
+
+
+def _isUnder(path, dirs):
+    for d in dirs:
+        if path == d or path.startswith(d + os.sep):
+            return True
+    return False
+
+
+class _PollingWatcher(object):
+    """Reports changes to the files under 'top' by walking the tree every
+    "interval" seconds and comparing stats. Directories under one of
+    the 'ignore' paths aren't looked at.
+    """
+    def __init__(self, top, ignore=(), interval=0.5):
+        self.top = top
+        self.ignore = ignore
+        self.interval = interval
+        self._stats = self._scan()
+
+    def _scan(self):
+        stats = {}
+        stack = [self.top]
+        while stack:
+            top = stack.pop()
+            try:
+                stats[top] = os.stat(top).st_mtime_ns
+                entries = list(os.scandir(top))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not _isUnder(entry.path, self.ignore):
+                            stack.append(entry.path)
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                stats[entry.path] = (st.st_mtime_ns, st.st_size)
+        return stats
+
+    def wait(self, timeout=None):
+        """Wait up to "timeout" seconds (forever if None) for changes.
+        Returns (<changed paths>, <dirs whose listing changed>), or None
+        if nothing changed.
+        """
+        deadline = timeout is not None and time.time() + timeout
+        while True:
+            delay = self.interval
+            if deadline:
+                delay = min(delay, deadline - time.time())
+                if delay < 0:
+                    return None
+            time.sleep(delay)
+            stats = self._scan()
+            if stats != self._stats:
+                break
+        paths, dirs = set(), set()
+        for path in set(stats) | set(self._stats):
+            old, new = self._stats.get(path), stats.get(path)
+            if old != new:
+                paths.add(path)
+                if old is None or new is None:
+                    dirs.add(os.path.dirname(path))
+                if isinstance(old, int) or isinstance(new, int):
+                    dirs.add(path)  # dirs have their mtime only
+        self._stats = stats
+        return paths, dirs
+
+    def close(self):
+        pass
+
+
+class _InotifyWatcher(object):
+    """Reports changes to the files under 'top' with Linux's inotify (used
+    through ctypes). Raises OSError where that isn't available.
+    """
+    _IN_MODIFY, _IN_ATTRIB, _IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    _IN_MOVED_FROM, _IN_MOVED_TO = 0x40, 0x80
+    _IN_CREATE, _IN_DELETE, _IN_DELETE_SELF = 0x100, 0x200, 0x400
+    _IN_Q_OVERFLOW, _IN_ISDIR = 0x4000, 0x40000000
+    _listingChanges = _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+    _mask = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _listingChanges \
+            | _IN_DELETE_SELF
+    _settle = 0.05  # to gather the events of one save in one batch
+
+    def __init__(self, top, ignore=()):
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                 use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.top = top
+        self.ignore = ignore
+        self._dirs = {}     # watch descriptor -> dir
+        self._addTree(top)
+
+    def _addTree(self, top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            if _isUnder(dirpath, self.ignore):
+                del dirnames[:]
+                continue
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath),
+                                              self._mask)
+            if wd >= 0:     # else it is already gone
+                self._dirs[wd] = dirpath
+
+    def _read(self):
+        import struct
+        data = b""
+        while True:
+            try:
+                chunk = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, pos)
+            name = data[pos+16:pos+16+length].rstrip(b"\0")
+            pos += 16 + length
+            yield wd, mask, os.fsdecode(name)
+
+    def wait(self, timeout=None):
+        """Wait up to "timeout" seconds (forever if None) for changes.
+        Returns (<changed paths>, <dirs whose listing changed>), or None
+        if nothing changed. <changed paths> is None if events were lost.
+        """
+        import select
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return None
+        paths, dirs = set(), set()
+        while True:
+            for wd, mask, name in self._read():
+                if mask & self._IN_Q_OVERFLOW:
+                    paths = None
+                    continue
+                top = self._dirs.get(wd)
+                if top is None:
+                    continue
+                path = name and os.path.join(top, name) or top
+                if _isUnder(path, self.ignore):
+                    continue
+                if paths is not None:
+                    paths.add(path)
+                if mask & self._listingChanges:
+                    dirs.add(top)
+                    if mask & self._IN_ISDIR:
+                        dirs.add(path)
+                        if mask & (self._IN_CREATE | self._IN_MOVED_TO):
+                            self._addTree(path)
+            if not select.select([self._fd], [], [], self._settle)[0]:
+                break
+        return paths, dirs
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _makeWatcher(top, ignore=(), interval=0.5):
+    try:
+        return _InotifyWatcher(top, ignore)
+    except (OSError, AttributeError, TypeError):
+        # No inotify (not Linux, or no usable libc).
+        return _PollingWatcher(top, ignore, interval)
+
+
+class _Watch(object):
+    """The state of watchWorkspace(): the include index, parsed files and
+    what each output depends on are kept between updates, so that an
+    update only has to remake the outputs affected by the changes.
+    """
+    def __init__(self, workspace, outdir, defines, indexPath=None,
+                 errfile=sys.stderr, manifestPath=None, cacheDir=None,
+                 binary=0, lineMap=0):
+        self.workspace = workspace = os.path.normpath(workspace)
+        self.outdir = outdir
+        self.errfile = errfile
+        self.binary = binary
+        self.lineMap = lineMap
+        self.index = _includeIndexes[workspace] = _IncludeIndex(workspace,
+                                                                indexPath)
+        if not isinstance(defines, MacroTable):
+            defines = MacroTable(defines)
+        self.defines = defines
+        self.cache = None
+        if cacheDir is not None:
+            self.cache = _OutputCache(cacheDir)
+        self.manifest = _Manifest(manifestPath, defines,
+                                  _workspaceOptions(binary, lineMap))
+        self.dependents = {}    # path -> set of infiles that read it
+        self._dependencies = {}     # infile -> paths it read
+        for infile, entry in self.manifest.entries.items():
+            self._setDependencies(infile, entry)
+
+    def _outfile(self, infile):
+        return os.path.join(self.outdir,
+                            infile[len(self.workspace)+1:])
+
+    def _isSource(self, path):
+        return path[-2:] in (".c", ".h") and self.index.hasFile(path)
+
+    def update(self, paths=None, dirs=(), jobs=1):
+        """Remake the outputs that depend on the changed 'paths' (all
+        outputs if None) and aren't up to date. Directories in 'dirs' had
+        files added or removed. Returns (<remade infiles>, <failures>).
+        """
+        index, manifest = self.index, self.manifest
+        if paths is None:
+            # Anything may have changed (e.g. the watcher overflowed):
+            # list every directory again.
+            index.refresh(index.dirs)
+        if paths is None or (dirs and index.refresh(dirs)):
+            # Files came or went: #include's may resolve differently.
+            candidates = [infile for infile, outfile
+                          in _workspaceFiles(index, self.outdir)]
+            for infile in list(manifest.entries):
+                if not self._isSource(infile):
+                    self._setDependencies(infile, None)
+        else:
+            candidates = set()
+            for path in paths:
+                candidates.update(self.dependents.get(path, ()))
+                if self._isSource(path):
+                    candidates.add(path)
+            candidates = sorted(candidates)
+        tasks = []
+        statCache = {}
+        for infile in candidates:
+            outfile = self._outfile(infile)
+            if not manifest.isUpToDate(infile, outfile, index, statCache):
+                tasks.append((self.workspace, infile, [outfile],
+                              self.binary, self.lineMap))
+        failures = _runWorkspaceTasks(tasks, jobs, index, [self.defines],
+                                      self.cache, [manifest], self.errfile)
+        remade = [task[1] for task in tasks]
+        for infile in remade:
+            self._setDependencies(infile, manifest.entries.get(infile))
+        return remade, failures
+
+    def _setDependencies(self, infile, entry):
+        for path in self._dependencies.pop(infile, ()):
+            self.dependents[path].discard(infile)
+        if entry is None:
+            self.manifest.discard(infile)
+            return
+        self._dependencies[infile] = list(entry["deps"])
+        for path in entry["deps"]:
+            self.dependents.setdefault(path, set()).add(infile)
+
+
+def watchWorkspace(workspace, outdir, defines={}, jobs=1, indexPath=None,
+                   errfile=sys.stderr, manifestPath=None, cacheDir=None,
+                   binary=0, interval=0.5, callback=None, lineMap=0):
+    """Preprocess 'workspace' like preprocessWorkspace(), then watch it
+    and remake the outputs affected by each change as it happens: a
+    change to a header remakes every file that #include's it, directly
+    or not. Changes are picked up with inotify where available, else by
+    polling every "interval" seconds.
+
+    "callback", if given, is called after each update with the list of
+    infiles remade and the list of (infile, <error message>) failures.
+    This never returns: interrupt it (KeyboardInterrupt) to stop.
+    """
+    watch = _Watch(workspace, outdir, defines, indexPath, errfile,
+                   manifestPath, cacheDir, binary, lineMap)
+    watcher = _makeWatcher(watch.workspace, [os.path.abspath(outdir)],
+                           interval)
+    try:
+        # Later updates are done in this process, where the caches are.
+        remade, failures = watch.update(jobs=jobs)
+        if callback is not None:
+            callback(remade, failures)
+        while True:
+            changes = watcher.wait()
+            if changes is None:
+                continue
+            remade, failures = watch.update(*changes)
+            if callback is not None:
+                callback(remade, failures)
+    finally:
+        watcher.close()
+
+
+#---- partial evaluation
+# Like unifdef: resolve the #if's that depend only on known macros and
+# keep, simplified, those that depend on others.
+
+def _exprText(node, minPrec=0):
+    """Return C text for the expression AST 'node' (see _CExpression),
+    parenthesized if its operator binds less than 'minPrec'.
+    """
+    kind = node[0]
+    if kind == "num":
+        text, prec = str(node[1]), node[1] < 0 and 14 or 15
+    elif kind == "name":
+        text, prec = node[1], 15
+    elif kind == "defined":
+        text, prec = "defined(%s)" % node[1], 15
+    elif kind == "unary":
+        operand = _exprText(node[2], 14)
+        if node[1] in "-+" and operand[:1] in ("-", "+"):
+            operand = " " + operand     # not "--" or "++"
+        text, prec = node[1] + operand, 14
+    elif kind == "binary":
+        prec = _binaryOps[node[1]][0]
+        text = "%s %s %s" % (_exprText(node[2], prec), node[1],
+                             _exprText(node[3], prec + 1))
+    else:
+        text, prec = "%s ? %s : %s" % (_exprText(node[1], 4),
+                                       _exprText(node[2]),
+                                       _exprText(node[3], 3)), 3
+    if prec < minPrec:
+        return "(%s)" % text
+    return text
+
+
+def _foldConstant(node):
+    # The value of AST 'node', whose leaves are all numbers.
+    return int(_evaluate(_exprText(node), {}))
+
+
+def _partialValue(node, defined, undefined, boolean=False):
+    """Partially evaluate the expression AST 'node' (see _CExpression)
+    for the macros in 'defined' (a dict of their values) and
+    'undefined', the others being unknown. Returns ("num", <value>) if
+    that's enough to get its value, else the AST simplified.
+
+    With "boolean", only whether the value is 0 matters, so "1 && X"
+    can be simplified to "X".
+    """
+    kind = node[0]
+    if kind == "num":
+        return node
+    elif kind == "defined":
+        if node[1] in defined:
+            return ("num", 1)
+        elif node[1] in undefined:
+            return ("num", 0)
+        return node
+    elif kind == "name":
+        name = node[1]
+        if name in undefined:
+            return ("num", 0)
+        elif name not in defined:
+            return node
+        value = defined[name]
+        if isinstance(value, str):
+            # Known only if its replacement text only uses known macros.
+            try:
+                names = _compileExpression(value).names
+            except PreprocessError:
+                return node
+            for other in names:
+                if other not in defined and other not in undefined:
+                    return node
+        return ("num", int(_macroValue(defined, name)))
+    elif kind == "unary":
+        operand = _partialValue(node[2], defined, undefined, node[1] == "!")
+        if operand[0] == "num":
+            return ("num", _foldConstant(("unary", node[1], operand)))
+        return ("unary", node[1], operand)
+    elif kind == "binary":
+        op = node[1]
+        logical = op in ("&&", "||")
+        left = _partialValue(node[2], defined, undefined, logical)
+        right = _partialValue(node[3], defined, undefined, logical)
+        if left[0] == "num" and right[0] == "num":
+            return ("num", _foldConstant(("binary", op, left, right)))
+        if logical:
+            # (There are no side effects: the order doesn't matter.)
+            absorbing = op == "||" and 1 or 0
+            for known, other in ((left, right), (right, left)):
+                if known[0] != "num":
+                    continue
+                if bool(known[1]) == bool(absorbing):
+                    return ("num", absorbing)
+                if boolean:
+                    return other
+        return ("binary", op, left, right)
+    else:
+        test = _partialValue(node[1], defined, undefined, True)
+        if test[0] == "num":
+            return _partialValue(test[1] and node[2] or node[3], defined,
+                                 undefined, boolean)
+        return ("cond", test,
+                _partialValue(node[2], defined, undefined, boolean),
+                _partialValue(node[3], defined, undefined, boolean))
+
+
+class _Reducer(object):
+    """The state of reducing one file, see reduceConditionals()."""
+
+    def __init__(self, defined, undefined, keepLines):
+        self.defined = dict(defined)
+        self.undefined = set(undefined) - set(defined)
+        self.known = set(self.defined) | self.undefined   # at the start
+        self.keepLines = keepLines
+
+    def _condition(self, node):
+        # Returns True, False or the text of the simplified condition
+        # (None if it can't be simplified, or parsed: e.g. a function-like
+        # macro call, which is then as unknown as the rest).
+        try:
+            expr = _compileExpression(node[3])
+            value = _partialValue(expr.ast, self.defined, self.undefined,
+                                  True)
+        except PreprocessError:
+            return None
+        if value[0] == "num":
+            return bool(value[1])
+        if value == expr.ast:
+            return None
+        return _exprText(value)
+
+    def _directive(self, node, directive):
+        # A line replacing that of 'node', with the same indentation.
+        line = node[2]
+        if isinstance(line, bytes):
+            return self._directive(node[:2] + (line.decode("latin-1"),),
+                                   directive).encode("latin-1")
+        text = line[:line.index("#") + 1] + directive
+        if line.endswith("\n"):
+            text += "\n"
+        return text
+
+    def _setMacro(self, name, value, certain):
+        # A #define (or #undef, if 'value' is _undefined) of 'name' in a
+        # branch taken for sure if 'certain', else maybe.
+        if name not in self.known:
+            return      # only the known macros are followed
+        self.defined.pop(name, None)
+        self.undefined.discard(name)
+        if not certain:
+            return
+        if value is _undefined:
+            self.undefined.add(name)
+        else:
+            self.defined[name] = value
+
+    def reduce(self, parsed, infile):
+        """Generate the reduced text of the _ParsedFile 'parsed'."""
+        if parsed.blockError is not None:
+            errmsg, lineNum, line = parsed.blockError
+            raise PreprocessError(errmsg, infile, lineNum, line)
+        keepLines = self.keepLines
+        SKIP, KEEP, EMIT = range(3)
+        # A block is [<state of this branch>, <an #if was written for
+        # it>, <a branch was taken for sure>, <parent active>, <parent
+        # certain>]: lines are written if "active", i.e. no enclosing
+        # branch is skipped, and macros are known to be (un)defined
+        # after a #define/#undef if "certain", i.e. all of them are
+        # taken for sure.
+        blocks = [[EMIT, False, True, True, True]]
+        for node in parsed.nodes:
+            op = node[0]
+            block = blocks[-1]
+            active = block[0] != SKIP and block[3]
+            line = node[2]
+            if op is None:
+                if active:
+                    yield line
+                elif keepLines:
+                    yield line[:0] + (isinstance(line, bytes) and b"\n"
+                                      or "\n") * node[3]
+                continue
+            output = None
+            if op == "if":
+                if not active:
+                    blocks.append([SKIP, False, True, False, False])
+                else:
+                    cond = self._condition(node)
+                    certain = block[0] == EMIT and block[4]
+                    if cond is True:
+                        blocks.append([EMIT, False, True, True, certain])
+                    elif cond is False:
+                        blocks.append([SKIP, False, False, True, certain])
+                    else:
+                        blocks.append([KEEP, True, False, True, certain])
+                        output = line
+                        if cond is not None:
+                            output = self._directive(node, "if " + cond)
+            elif op in ("elif", "else"):
+                if not block[3] or block[2]:
+                    block[0] = SKIP
+                else:
+                    if op == "else":
+                        cond = True
+                    else:
+                        cond = self._condition(node)
+                    if cond is True:
+                        block[2] = True
+                        if block[1]:
+                            block[0] = KEEP
+                            output = self._directive(node, "else")
+                            if op == "else":
+                                output = line
+                        else:
+                            block[0] = EMIT
+                    elif cond is False:
+                        block[0] = SKIP
+                    else:
+                        block[0] = KEEP
+                        if block[1]:
+                            output = line
+                            if cond is not None:
+                                output = self._directive(node,
+                                                         "elif " + cond)
+                        else:
+                            output = self._directive(node, "if " + (
+                                cond is None and node[3].strip() or cond))
+                        block[1] = True
+            elif op == "endif":
+                blocks.pop()
+                if block[1]:
+                    output = line
+            elif active:
+                output = line
+                certain = block[0] == EMIT and block[4]
+                if op == "define":
+                    value = node[4]
+                    if value is not None:
+                        value = value.strip()
+                    self._setMacro(node[3], value, certain)
+                elif op == "undef":
+                    self._setMacro(node[3], _undefined, certain)
+            if output is not None:
+                yield output
+            elif keepLines:
+                yield line[:0] + (isinstance(line, bytes) and b"\n" or "\n")
+
+
+def reduceConditionals(infile, outfile=sys.stdout, defined={},
+                       undefined=(), keepLines=0, binary=0, force=0):
+    """Write 'infile' to 'outfile' (a path or a stream) with the #if's
+    resolved as far as the known macros allow, like unifdef does.
+
+    Macros are known to be defined ("defined", a dict of their values)
+    or undefined (those in "undefined"), all others are unknown. Blocks
+    whose conditions only depend on known macros are resolved: their
+    directives and false branches are dropped. Conditions that depend
+    on unknown macros are kept, simplified (e.g. "#if A && B" with A
+    defined to 1 becomes "#if B") and #elif's become #if's where the
+    branches before them were dropped. Conditions that can't be parsed
+    (e.g. "#if GCC_VERSION(4, 2)") are kept as unknown. Everything else
+    is written as is: #include's are not followed and nothing is
+    substituted.
+
+    A #define or #undef of a known macro in a branch that is always
+    taken changes its value for the rest of the file; in a kept branch
+    the macro becomes unknown.
+
+    With "keepLines" the lines removed are replaced by blank lines.
+    "binary" and "force" are as for preprocess().
+    """
+    infile = os.fsdecode(infile)
+    parsed = _getParsedFile(infile, cache=False, binary=binary)
+    chunks = _Reducer(defined, undefined, keepLines).reduce(parsed, infile)
+    if not isinstance(outfile, (str, bytes)):
+        for chunk in chunks:
+            outfile.write(chunk)
+        return
+    # Written aside and moved in place, see _updateOutput().
+    outfile = os.fsdecode(outfile)
+    tmpPath = _tempPath(outfile)
+    try:
+        fout = open(tmpPath, binary and 'wb' or 'w')
+        try:
+            for chunk in chunks:
+                fout.write(chunk)
+        finally:
+            fout.close()
+    except:
+        os.remove(tmpPath)
+        raise
+    _updateOutput(tmpPath, outfile, force)
+
+
+def reduceWorkspace(workspace, outdir, defined={}, undefined=(),
+                    indexPath=None, errfile=sys.stderr, keepLines=0,
+                    binary=0):
+    """Reduce every .c and .h file under 'workspace' with
+    reduceConditionals() to the same relative path under 'outdir', for
+    later preprocessing with the macros left unknown.
+
+    Returns the list of (infile, <error message>) for failed files.
+    """
+    workspace = os.path.normpath(workspace)
+    index = _includeIndexes[workspace] = _IncludeIndex(workspace, indexPath)
+    failures = []
+    for infile, outfile in _workspaceFiles(index, outdir):
+        try:
+            if not os.path.isdir(os.path.dirname(outfile)):
+                os.makedirs(os.path.dirname(outfile))
+            reduceConditionals(infile, outfile, defined, undefined,
+                               keepLines, binary, force=1)
+        except (PreprocessError, EnvironmentError) as ex:
+            failures.append((infile, str(ex)))
+            if errfile is not None:
+                errfile.write("preprocess: error: %s\n" % ex)
+    return failures
+
+
+#---- server
+
+_serverOptions = ("force", "keepLines", "includePath", "substitute",
+                  "include_substitute", "substituteSkipStrings", "binary")
+
+def _serveRequest(request, refreshed, refreshInterval):
+    """Run one server request, see serve(), and return the response."""
+    workspace = os.path.normpath(request["workspace"])
+    index = _includeIndexes.get(workspace)
+    now = time.time()
+    if index is None or now - refreshed.get(workspace, 0) > refreshInterval:
+        if index is not None:
+            index.refresh()
+        refreshed[workspace] = now
+    options = dict((name, request[name]) for name in _serverOptions
+                   if name in request)
+    force = options.pop("force", 0)
+    defines = request.get("defines", {})
+    outfile = request.get("outfile")
+    # Not preprocess(): the index is refreshed on the interval above,
+    # not on every request.
+    run = _Run(workspace, **options)
+    if outfile is None:
+        if run.binary:
+            fout = io.BytesIO()
+        else:
+            fout = io.StringIO()
+        defines = _preprocessTo(run, request["infile"], fout, defines, force)
+        output = fout.getvalue()
+        if isinstance(output, bytes):
+            output = output.decode("latin-1")
+        return {"defines": defines, "output": output}
+    defines = _preprocessTo(run, request["infile"], outfile, defines, force)
+    return {"defines": defines}
+
+
+def _serveLine(line, refreshed, refreshInterval):
+    """Return the response line to a server request line, or None for a
+    shutdown request.
+    """
+    try:
+        request = json.loads(line)
+        if request.get("shutdown"):
+            return None
+        response = _serveRequest(request, refreshed, refreshInterval)
+        # Defined values are eval()'d, so e.g. "#define INT_T int" maps to
+        # a builtin: send the repr() of anything JSON cannot carry.
+        text = json.dumps(response, default=repr)
+    except (PreprocessError, EnvironmentError) as ex:
+        text = json.dumps({"error": str(ex)})
+    except Exception as ex:
+        text = json.dumps({"error": "%s: %s" % (ex.__class__.__name__, ex)})
+    return text.encode("utf-8") + b"\n"
+
+
+def serve(socketPath, refreshInterval=2.0):
+    """Preprocess files for clients connecting to the Unix domain socket
+    'socketPath', until a client asks to shut down.
+
+    This saves clients the start-up of a process per file, and requests
+    are served with the caches (parsed files, include indexes, compiled
+    #if expressions) warm. Requests are served one at a time.
+
+    A client sends requests and reads the responses one per line, as
+    JSON objects. A request has the preprocess() arguments: "workspace",
+    "infile", optionally "outfile", "defines" (an object) and the options
+    "force", "keepLines", "includePath", "substitute",
+    "include_substitute", "substituteSkipStrings" and "binary". The
+    response has the "defines" at the end of the file and, without an
+    "outfile", the "output" (Latin-1 decoded with "binary"); or an
+    "error" message. The request {"shutdown": true} stops the server.
+
+    The include index of a workspace is brought up to date before a
+    request if it wasn't in the last "refreshInterval" seconds.
+    """
+    import socket, selectors
+    if os.path.exists(socketPath):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(socketPath)
+        except OSError:
+            os.remove(socketPath)   # left over by a server that died
+        else:
+            client.close()
+            raise PreprocessError("a server is already listening on %s"
+                                  % socketPath)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketPath)
+    refreshed = {}      # workspace -> when its index was last refreshed
+    # Idle clients mustn't hold up the others: connections are waited
+    # on together, the requests are run one at a time.
+    selector = selectors.DefaultSelector()
+    buffers = {}        # connection -> bytes received of the next request
+    try:
+        server.listen(64)
+        selector.register(server, selectors.EVENT_READ)
+        while True:
+            for key, events in selector.select():
+                if key.fileobj is server:
+                    conn = server.accept()[0]
+                    buffers[conn] = b""
+                    selector.register(conn, selectors.EVENT_READ)
+                    continue
+                conn = key.fileobj
+                try:
+                    data = conn.recv(65536)
+                    lines = (buffers[conn] + data).split(b"\n")
+                    buffers[conn] = lines.pop()
+                    for line in lines:
+                        response = _serveLine(line, refreshed,
+                                              refreshInterval)
+                        if response is None:
+                            conn.sendall(b"{}\n")
+                            return
+                        conn.sendall(response)
+                except OSError:
+                    data = b""  # the client went away
+                if not data:
+                    selector.unregister(conn)
+                    del buffers[conn]
+                    conn.close()
+    finally:
+        for conn in buffers:
+            conn.close()
+        selector.close()
+        server.close()
+        os.remove(socketPath)
+
+
 #---- mainline
 
-def main():
-    workspace = r"D:\master" #Local directory to define as target input.
+def main(argv=sys.argv):
+    import optparse
+    parser = optparse.OptionParser(prog="preprocess",
+        usage="%prog [options] [WORKSPACE]",
+        description="Preprocess the .c and .h files of WORKSPACE (by "
+                    "default %s) for call tree analysis." % _defaultWorkspace)
+    parser.add_option("-o", "--output-dir", dest="outdir",
+        help="directory for the output files (default: a folder named "
+             "'output' next to the workspace)")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+        help="number of files to preprocess in parallel (default: 1)")
+    parser.add_option("-b", "--binary", action="store_true",
+        help="read the files as bytes without decoding them, for speed "
+             "and for files that aren't in the locale's encoding")
+    parser.add_option("-D", dest="defines", action="append", default=[],
+        metavar="NAME[=VALUE]", help="define a macro")
+    parser.add_option("-U", dest="undefines", action="append", default=[],
+        metavar="NAME", help="undefine a macro")
+    parser.add_option("--reduce", action="store_true",
+        help="only resolve the #if's that depend on the macros given with "
+             "-D and -U, keeping the others (like unifdef), instead of "
+             "preprocessing")
+    parser.add_option("--cache-dir", dest="cacheDir",
+        help="directory of the store of preprocessed outputs re-used "
+             "between runs (default: '.cache' in the output directory)")
+    parser.add_option("-B", "--always-make", action="store_true",
+        help="preprocess all files, not only those whose inputs changed "
+             "since the last run")
+    parser.add_option("--stats", action="store_true",
+        help="report where the time went, and the headers that took the "
+             "most, on stderr")
+    parser.add_option("--stats-top", type="int", default=10, metavar="N",
+        help="number of headers in the --stats report (default: 10)")
+    parser.add_option("--trace", metavar="FILE",
+        help="write a trace of the files processed and their #include's "
+             "to FILE, in the Chrome trace event format")
+    parser.add_option("--trace-stacks", metavar="FILE",
+        help="write the time spent in each chain of #include's to FILE, "
+             "in the collapsed stack format of flamegraph.pl")
+    parser.add_option("--include-graph", metavar="FILE",
+        help="write the #include's processed for each file to FILE, as "
+             "JSON lines")
+    parser.add_option("--configurations", metavar="FILE",
+        help="preprocess for each configuration in FILE, a JSON object "
+             "{NAME: {MACRO: VALUE, ...}, ...}, in one pass, to "
+             "OUTPUT_DIR/NAME")
+    parser.add_option("--line-map", action="store_true",
+        help="write next to each output a .linemap file mapping its "
+             "lines to their source file and line")
+    parser.add_option("--serve", metavar="SOCKET",
+        help="serve preprocessing requests on the Unix domain socket "
+             "SOCKET (see bin/preprocess-client) instead")
+    parser.add_option("-w", "--watch", action="store_true",
+        help="keep running and remake the outputs affected by each "
+             "change to the workspace, until interrupted")
+    opts, args = parser.parse_args(argv[1:])
+    if opts.serve:
+        serve(opts.serve)
+        return
+    if len(args) > 1:
+        parser.error("too many arguments")
+    elif args:
+        workspace = args[0]
+    else:
+        workspace = _defaultWorkspace
+    if opts.jobs < 1:
+        parser.error("-j/--jobs must be at least 1")
+    configurations = None
+    if opts.configurations:
+        if opts.watch:
+            parser.error("--configurations can't be used with -w/--watch")
+        try:
+            fin = open(opts.configurations)
+            try:
+                configurations = json.load(fin)
+            finally:
+                fin.close()
+        except (EnvironmentError, ValueError) as ex:
+            parser.error("could not read %s: %s" % (opts.configurations, ex))
+        if not isinstance(configurations, dict) \
+           or not all(isinstance(defines, dict)
+                      for defines in configurations.values()):
+            parser.error("%s is not a JSON object of objects"
+                         % opts.configurations)
+    workspace = os.path.normpath(workspace)
     defines = {}
-    for r,d,f in os.walk(workspace):
-        for file in f:
-            # Only take .c and .h as target.
-            if file[-2:] in [".c", ".h"]:
-                infile = os.path.join(r,file)
-                # Default output directory is a folder named 'output' under the same root as the workspace folder.
-                outfile = os.path.join(workspace[:workspace.rindex("\\")+1],"output",r[len(workspace)+1:],file)
-                preprocess(workspace, infile, outfile, defines, 1)
+    for define in opts.defines:
+        name, _, value = define.partition("=")
+        try:
+            defines[name] = int(value or "1", 0)
+        except ValueError:
+            defines[name] = value
+    for name in opts.undefines:
+        defines.pop(name, None)
+    # Default output directory is a folder named 'output' under the same root as the workspace folder.
+    outdir = opts.outdir or os.path.join(os.path.dirname(workspace), "output")
+    if opts.reduce:
+        if opts.watch or configurations is not None:
+            parser.error("--reduce can't be used with -w/--watch or "
+                         "--configurations")
+        if reduceWorkspace(workspace, outdir, defines, opts.undefines,
+                           os.path.join(outdir, ".includeindex"),
+                           binary=opts.binary):
+            return 1
+        return
+    # The include index, the dependency manifest and the output store
+    # are kept with the output so that a re-run only has to stat the
+    # workspace dirs and only remakes the outputs whose inputs changed.
+    manifestPath = os.path.join(outdir, ".manifest")
+    if opts.always_make:
+        for name in configurations or [None]:
+            path = _configurationPath(manifestPath, name)
+            if os.path.exists(path):
+                os.remove(path)
+    cacheDir = opts.cacheDir or os.path.join(outdir, ".cache")
+    if opts.watch:
+        def report(remade, failures):
+            if remade:
+                sys.stderr.write("preprocess: %d file(s) remade, %d failed\n"
+                                 % (len(remade), len(failures)))
+        try:
+            watchWorkspace(workspace, outdir, defines, opts.jobs,
+                           os.path.join(outdir, ".includeindex"),
+                           manifestPath=manifestPath, cacheDir=cacheDir,
+                           binary=opts.binary, callback=report,
+                           lineMap=opts.line_map)
+        except KeyboardInterrupt:
+            pass
+        return
+    stats = None
+    if opts.stats or opts.trace or opts.trace_stacks:
+        stats = PreprocessStats(trace=bool(opts.trace or opts.trace_stacks))
+    failures = preprocessWorkspace(workspace, outdir, defines, opts.jobs,
+                                   os.path.join(outdir, ".includeindex"),
+                                   manifestPath=manifestPath,
+                                   cacheDir=cacheDir, binary=opts.binary,
+                                   stats=stats,
+                                   includeGraphPath=opts.include_graph,
+                                   lineMap=opts.line_map,
+                                   configurations=configurations)
+    if opts.stats:
+        stats.report(sys.stderr, opts.stats_top)
+    if opts.trace:
+        fout = open(opts.trace, 'w')
+        try:
+            stats.writeChromeTrace(fout)
+        finally:
+            fout.close()
+    if opts.trace_stacks:
+        fout = open(opts.trace_stacks, 'w')
+        try:
+            stats.writeCollapsedStacks(fout)
+        finally:
+            fout.close()
+    if failures:
+        return 1
 
 
 if __name__ == "__main__":
@@ -60,6 +60,7 @@ setup(
     py_modules=["preprocess"],
     package_dir={"": "lib"},
     entry_points={'console_scripts': ['preprocess = preprocess:main']},
+    scripts=["bin/preprocess-client"],
     description=doclines[0],
     classifiers=filter(None, classifiers.split("\n")),
     long_description="\n".join(doclines[2:]),
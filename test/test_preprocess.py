@@ -26,6 +26,8 @@ import sys
 import os
 import unittest
 import difflib
+import shutil
+import time
 import pprint
 
 import testsupport
@@ -61,6 +63,727 @@ class PreprocessTestCase(unittest.TestCase):
                       "re-used list of already preprocessed files froma "\
                       "previous call.")
 
+    def _writeFiles(self, root, files):
+        for path, content in files.items():
+            path = os.path.join(root, path)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fout = open(path, 'w')
+            fout.write(content)
+            fout.close()
+
+    def test_include_resolution_order(self):
+        # The including file's directory wins over the workspace walk
+        # order, and the workspace walk is the fallback.
+        import preprocess
+        workspace = os.path.join(self.tmpdir, "include_resolution_order")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        self._writeFiles(workspace, {
+            "a.h": "top a\n",
+            "src/a.h": "src a\n",
+            "inc/b.h": "inc b\n",
+            "src/main.c": '#include "a.h"\n#include "b.h"\n',
+        })
+        index = preprocess._IncludeIndex(workspace)
+        srcdir = os.path.join(index.workspace, "src")
+        self.assertEqual(index.resolve("a.h", srcdir),
+                         os.path.join(srcdir, "a.h"))
+        self.assertEqual(index.resolve("b.h", srcdir),
+                         os.path.join(index.workspace, "inc", "b.h"))
+        self.assertEqual(index.resolve("nosuchfile.h", srcdir), None)
+        # A header created between two preprocess() calls is found by the
+        # second one.
+        from io import StringIO
+        self._writeFiles(workspace, {"new.c": '#include "new.h"\n'})
+        newc = os.path.join(workspace, "new.c")
+        self.assertRaises(preprocess.PreprocessError, preprocess.preprocess,
+                          workspace, newc, StringIO())
+        self._writeFiles(workspace, {"inc/new.h": "new\n"})
+        fout = StringIO()
+        preprocess.preprocess(workspace, newc, fout)
+        self.assertEqual(fout.getvalue(), 'new\n#include "new.h"\n')
+
+    def test_include_guard(self):
+        import preprocess
+        from io import StringIO
+        workspace = os.path.join(self.tmpdir, "include_guard")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        self._writeFiles(workspace, {
+            "guarded.h": "#ifndef GUARDED_H\n#define GUARDED_H\n"
+                         "int guarded;\n#endif\n",
+            "main.c": '#include "guarded.h"\n#include "guarded.h"\n',
+        })
+        guarded = os.path.join(workspace, "guarded.h")
+        fout = StringIO()
+        preprocess.preprocess(workspace, os.path.join(workspace, "main.c"),
+                              fout, {})
+        self.assertEqual(fout.getvalue(),
+            '#define GUARDED_H\nint guarded;\n#include "guarded.h"\n'
+            '#define GUARDED_H\n#include "guarded.h"\n')
+        self.assertEqual(preprocess._parsedFiles[guarded].guardMacro,
+                         "GUARDED_H")
+
+    def test_parsed_file_cache(self):
+        import preprocess
+        workspace = os.path.join(self.tmpdir, "parsed_file_cache")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        self._writeFiles(workspace, {"a.h": "#if FOO\nfoo\n#endif\n"})
+        path = os.path.join(workspace, "a.h")
+        parsed = preprocess._getParsedFile(path)
+        self.assertEqual([node[0] for node in parsed.nodes],
+                         ["if", None, "endif"])
+        self.assertTrue(preprocess._getParsedFile(path) is parsed)
+        self._writeFiles(workspace, {"a.h": "#if FOO\nfoo\nbar\n#endif\n"})
+        self.assertEqual(preprocess._getParsedFile(path).numLines, 4)
+
+    def test_skipped_branches(self):
+        import preprocess
+        from io import StringIO
+        workspace = os.path.join(self.tmpdir, "skipped_branches")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        self._writeFiles(workspace, {
+            "a.c": "#if 0\nx\n#if 1\n#define X 1\n#endif\n"
+                   "#elif 0\nfoo\n#else\ny\n#endif\nz\n",
+            "bad.c": "a\n#if 1\nb\n#else\nc\n#else\nd\n#endif\n",
+        })
+        path = os.path.join(workspace, "a.c")
+        parsed = preprocess._getParsedFile(path)
+        self.assertEqual(parsed.branches, {1: (1, 5), 3: (3, 4), 6: (6, 7),
+                                           8: (8, 9)})
+        # Jumped over, false branches still output their #define lines.
+        for keepLines, expected in [
+                (0, "#define X 1\ny\nz\n"),
+                (1, "\n\n\n#define X 1\n\n\n\n\n\ny\n\nz\n")]:
+            fout = StringIO()
+            defines = preprocess.preprocess(workspace, path, fout, {},
+                                            keepLines=keepLines)
+            self.assertEqual(fout.getvalue(), expected)
+            self.assertFalse("X" in defines)
+        # Unbalanced blocks are reported before any output.
+        fout = StringIO()
+        try:
+            preprocess.preprocess(workspace,
+                                  os.path.join(workspace, "bad.c"), fout)
+        except preprocess.PreprocessError as ex:
+            self.assertEqual((ex.errmsg, ex.lineno),
+                             ("illegal #else after #else in same #if block",
+                              6))
+        else:
+            self.fail("no error for a second #else")
+        self.assertEqual(fout.getvalue(), "")
+
+    def test_reduce_conditionals(self):
+        import preprocess
+        from io import StringIO
+        workspace = os.path.join(self.tmpdir, "reduce_conditionals")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        self._writeFiles(workspace, {"a.c":
+            "#ifdef ARM\narm\n#elif VER > 2 && X86\nx86\n#else\nold\n"
+            "#endif\n"
+            "#if VER == 3 || DEBUG\nv3\n#endif\n"
+            "#if X\n#define VER 2\n#endif\n#if VER == 3\nver\n#endif\n"})
+        fout = StringIO()
+        preprocess.reduceConditionals(os.path.join(workspace, "a.c"), fout,
+                                      {"VER": 3}, ["ARM"])
+        # The #elif becomes an #if, "VER > 2 &&" is dropped; VER is
+        # unknown after a #define that may happen.
+        self.assertEqual(fout.getvalue(),
+            "#if X86\nx86\n#else\nold\n#endif\nv3\n"
+            "#if X\n#define VER 2\n#endif\n#if VER == 3\nver\n#endif\n")
+        # A certain #undef makes the macro known to be undefined.
+        self._writeFiles(workspace, {"u.c":
+            "#ifdef FOO\n#undef FOO\n#endif\n"
+            "#ifdef FOO\nstill\n#else\ngone\n#endif\n"})
+        fout = StringIO()
+        preprocess.reduceConditionals(os.path.join(workspace, "u.c"), fout,
+                                      {"FOO": 1}, [])
+        self.assertEqual(fout.getvalue(), "#undef FOO\ngone\n")
+        fout = StringIO()
+        defines = preprocess.preprocess(workspace,
+                                        os.path.join(workspace, "u.c"),
+                                        fout, {"FOO": 1})
+        self.assertEqual(fout.getvalue(), "gone\n")
+        self.assertFalse("FOO" in defines)
+        # Conditions that can't be parsed are kept as unknown.
+        self._writeFiles(workspace, {"p.c":
+            "#if GCC_VERSION(4, 2) && FOO\na\n#elif FOO\nb\n#endif\n"})
+        fout = StringIO()
+        preprocess.reduceConditionals(os.path.join(workspace, "p.c"), fout,
+                                      {"FOO": 1}, [])
+        self.assertEqual(fout.getvalue(),
+            "#if GCC_VERSION(4, 2) && FOO\na\n#else\nb\n#endif\n")
+
+    def test_region_source(self):
+        import preprocess
+        source = preprocess._RegionSource(
+            "a\nSTART 1\nb\nSTART 2\nc\nEND\nd\nSTART 3\nEND", None, None, 0)
+        for from_, to_, last_to_line, expected in [
+                ("START", "END", 1, "START 2\nc\nEND\n"),
+                ("START", "END", 0, "START 2\nc\n"),
+                ("START", "", 0, "START 3\nEND"),
+                ("^START [13]$", "^END$", 1, "START 1\nb\nSTART 2\nc\nEND\n"),
+                ("NOSUCH", "END", 1, "END"),
+            ]:
+            self.assertEqual(source.region(from_, to_, last_to_line),
+                             expected, "%r@%r" % (from_, to_))
+        # The 'to' pattern of a "fromto:" directive ends in a newline, so it
+        # only matches a line ending in the word.
+        from io import StringIO
+        workspace = os.path.join(self.tmpdir, "region_source")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        self._writeFiles(workspace, {
+            "src.txt": "a\nSTART\nend of block marker here\nx\nend\ny\n",
+            "main.c": '#include "src.txt" fromto: START@end\n',
+        })
+        fout = StringIO()
+        preprocess.preprocess(workspace, os.path.join(workspace, "main.c"),
+                              fout)
+        self.assertEqual(fout.getvalue(),
+                         'START\nend of block marker here\nx\n'
+                         '#include "src.txt" fromto: START@end\n')
+
+    def test_parse_text(self):
+        import preprocess
+        nodes = preprocess._parseText("a\n  # if X\nb\n#pragma once\n"
+                                      "c\n#endif")
+        self.assertEqual(nodes, [
+            (None, 1, "a\n", 1),
+            ("if", 2, "  # if X\n", "X", "if"),
+            (None, 3, "b\n#pragma once\nc\n", 3),
+            ("endif", 6, "#endif"),
+        ])
+
+    def test_substitute(self):
+        import preprocess
+        from io import StringIO
+        workspace = os.path.join(self.tmpdir, "substitute")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        self._writeFiles(workspace, {
+            "a.c": '#define FOO 3\nFOO FOOD "FOO" /* FOO */ 10L\n'
+                   '__LINE__\n',
+        })
+        fout = StringIO()
+        preprocess.preprocess(workspace, os.path.join(workspace, "a.c"),
+                              fout, {"L": 0}, substitute=1)
+        self.assertEqual(fout.getvalue(),
+                         '#define FOO 3\n3 FOOD "3" /* 3 */ 10L\n3\n')
+        fout = StringIO()
+        preprocess.preprocess(workspace, os.path.join(workspace, "a.c"),
+                              fout, {"L": 0}, substitute=1,
+                              substituteSkipStrings=1)
+        self.assertEqual(fout.getvalue(),
+                         '#define FOO 3\n3 FOOD "FOO" /* FOO */ 10L\n3\n')
+
+    def test_preprocess_iter(self):
+        import preprocess
+        from io import StringIO
+        workspace = os.path.join(self.tmpdir, "preprocess_iter")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        self._writeFiles(workspace, {
+            "a.h": "#define FROM_A 1\n",
+            "main.c": '#include "a.h"\n#if FROM_A\n' + "x = 1u;\n" * 100
+                      + "#else\nno\n#endif\nlast\n",
+        })
+        infile = os.path.join(workspace, "main.c")
+        fout = StringIO()
+        expectedDefines = preprocess.preprocess(workspace, infile, fout, {})
+        defines = {}
+        chunks = list(preprocess.preprocessIter(workspace, infile, defines,
+                                                chunkSize=64))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual("".join(chunks), fout.getvalue())
+        self.assertEqual(defines, expectedDefines)
+        # Without "defines", nothing is left over for the next call.
+        self._writeFiles(workspace, {"b.c": "#ifdef FROM_A\nleaked\n#endif\n"})
+        list(preprocess.preprocessIter(workspace, infile))
+        self.assertEqual("".join(preprocess.preprocessIter(
+            workspace, os.path.join(workspace, "b.c"))), "")
+
+    def test_binary(self):
+        import preprocess
+        from io import BytesIO
+        workspace = os.path.join(self.tmpdir, "binary")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        self._writeFiles(workspace, {"a.h": "#define FROM_A 1\n"})
+        infile = os.path.join(workspace, "main.c")
+        fout = open(infile, 'wb')
+        fout.write(b'#include "a.h"\n#if FROM_A\n"\xff\xfe" 10u;\r\n'
+                   b'#else\nno\n#endif\n')
+        fout.close()
+        fout = BytesIO()
+        preprocess.preprocess(workspace, infile, fout, {}, binary=1)
+        self.assertEqual(fout.getvalue(),
+            b'#define FROM_A 1\n#include "a.h"\n"\xff\xfe" 10;\r\n')
+        self.assertEqual(b"".join(preprocess.preprocessIter(workspace,
+                             infile, {}, binary=1)), fout.getvalue())
+
+    def test_evaluate(self):
+        import preprocess
+        defines = {"ONE": 1, "FIVE": 5, "EXPR": "ONE + FIVE", "EMPTY": None}
+        for expr, expected in [
+                ("ONE && FIVE", 1),
+                ("defined(ONE) && !defined UNDEFINED", 1),
+                ("UNDEFINED || 0", 0),
+                ("FIVE > 4 ? 0x10UL : 010", 16),
+                ("ONE << 3 | 1", 9),
+                ("'A' == 65", 1),
+                ("-7 / 2", -3),
+                ("EXPR * 2 /* comment */", 12),
+                ("EMPTY", 0),
+                ("0 && 1/0", 0),
+            ]:
+            self.assertEqual(preprocess._evaluate(expr, defines), expected,
+                             "%r" % expr)
+        for expr in ["1 +", "(1", "ONE FIVE", "1/0"]:
+            self.assertRaises(preprocess.PreprocessError,
+                              preprocess._evaluate, expr, defines)
+
+    def test_condition_cache(self):
+        import preprocess
+        expr = "defined(CACHE_A) && CACHE_B > 1"
+        before = preprocess.getConditionCacheStats()
+        self.assertEqual(preprocess._evaluate(expr, {"CACHE_B": 2}), 0)
+        self.assertEqual(preprocess._evaluate(expr, {"CACHE_B": 2}), 0)
+        self.assertEqual(preprocess._evaluate(expr,
+                         {"CACHE_A": None, "CACHE_B": 2}), 1)
+        after = preprocess.getConditionCacheStats()
+        self.assertEqual(after["hits"] - before["hits"], 1)
+        self.assertEqual(after["misses"] - before["misses"], 2)
+
+    def test_macro_table(self):
+        import preprocess
+        table = preprocess.MacroTable({"A": 1, "B": 2})
+        snapshot = table.snapshot()
+        table["A"] = 10
+        del table["B"]
+        table["__LINE__"] = 42
+        self.assertEqual(dict(snapshot), {"A": 1, "B": 2})
+        self.assertEqual(dict(table), {"A": 10, "__LINE__": 42})
+        self.assertEqual(len(table), 2)
+        self.assertRaises(KeyError, table.__getitem__, "B")
+        # Fingerprints depend on the contents only, not on history or
+        # the current position.
+        self.assertEqual(table.fingerprint(),
+                         preprocess.MacroTable({"A": 10}).fingerprint())
+        self.assertNotEqual(table.fingerprint(), snapshot.fingerprint())
+        with table.overlay() as scoped:
+            scoped["C"] = 3
+        self.assertFalse("C" in table)
+
+    def test_preprocess_workspace(self):
+        import preprocess
+        workspace = os.path.join(self.tmpdir, "workspace_jobs")
+        outdir = os.path.join(self.tmpdir, "workspace_jobs_out")
+        for path in (workspace, outdir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        self._writeFiles(workspace, {
+            "a.c": "#define LEAK 1\na\n",
+            "b.c": "#if defined(LEAK)\nleaked\n#endif\nb\n",
+            "sub/bad.c": "#if 1 +\n#endif\n",
+        })
+        failures = preprocess.preprocessWorkspace(workspace, outdir, {},
+                                                  jobs=2, errfile=None)
+        self.assertEqual([os.path.basename(f) for f, err in failures],
+                         ["bad.c"])
+        self.assertEqual(open(os.path.join(outdir, "b.c")).read(), "b\n")
+
+    def test_configurations(self):
+        import preprocess
+        workspace = os.path.join(self.tmpdir, "configurations")
+        outdir = os.path.join(self.tmpdir, "configurations_out")
+        for path in (workspace, outdir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        self._writeFiles(workspace, {
+            "a.h": "#if ARCH == 2\n#error no arch 2\n#endif\n",
+            "a.c": '#include "a.h"\n#if ARCH == 1\narm\n#elif DEBUG\n'
+                   'debug\n#endif\n',
+        })
+        manifestPath = os.path.join(outdir, ".manifest")
+        configurations = {"arm": {"ARCH": 1}, "debug": {},
+                          "bad": {"ARCH": 2}}
+        for i in range(2):
+            failures = preprocess.preprocessWorkspace(
+                workspace, outdir, {"ARCH": 0, "DEBUG": 1}, errfile=None,
+                manifestPath=manifestPath, configurations=configurations)
+            self.assertEqual(sorted(set(err.split(" ", 1)[0]
+                                        for f, err in failures)), ["[bad]"])
+        self.assertTrue(open(os.path.join(outdir, "arm", "a.c")).read()
+                        .endswith("arm\n"))
+        self.assertTrue(open(os.path.join(outdir, "debug", "a.c")).read()
+                        .endswith("debug\n"))
+        self.assertTrue(os.path.exists(manifestPath + ".arm"))
+
+    def test_incremental_workspace(self):
+        import preprocess
+        workspace = os.path.join(self.tmpdir, "incremental")
+        outdir = os.path.join(self.tmpdir, "incremental_out")
+        manifestPath = os.path.join(outdir, ".manifest")
+        for path in (workspace, outdir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        self._writeFiles(workspace, {
+            "inc/a.h": "a\n",
+            "b.c": '#include "a.h"\nb\n',
+            "c.c": "c\n",
+        })
+        preprocess.preprocessWorkspace(workspace, outdir,
+                                       manifestPath=manifestPath)
+        bOut = os.path.join(outdir, "b.c")
+        cOut = os.path.join(outdir, "c.c")
+        # Only the file whose #include'd header changed is made again.
+        self._writeFiles(workspace, {"inc/a.h": "a2\n"})
+        open(cOut, 'w').close()
+        preprocess.preprocessWorkspace(workspace, outdir,
+                                       manifestPath=manifestPath)
+        self.assertEqual(open(bOut).read(), 'a2\n#include "a.h"\nb\n')
+        self.assertEqual(open(cOut).read(), "")
+        # A new header that takes over an #include is a change too.
+        self._writeFiles(workspace, {"a.h": "top a\n"})
+        preprocess.preprocessWorkspace(workspace, outdir,
+                                       manifestPath=manifestPath)
+        self.assertEqual(open(bOut).read(), 'top a\n#include "a.h"\nb\n')
+        # The files of a pass are stat()'ed once, whatever #include's them.
+        manifest = preprocess._Manifest(manifestPath, preprocess.MacroTable(),
+                                        preprocess._workspaceOptions(0, 0))
+        index = preprocess._IncludeIndex(workspace)
+        statCache = {}
+        for name in ("b.c", "b.c", "c.c"):
+            self.assertTrue(manifest.isUpToDate(
+                os.path.join(index.workspace, name),
+                os.path.join(outdir, name), index, statCache))
+        self.assertEqual(sorted(os.path.basename(path) for path in statCache),
+                         ["a.h", "b.c", "c.c"])
+
+    def test_output_cache(self):
+        import preprocess
+        workspace = os.path.join(self.tmpdir, "output_cache")
+        outdir = os.path.join(self.tmpdir, "output_cache_out")
+        cacheDir = os.path.join(self.tmpdir, "output_cache_store")
+        for path in (workspace, outdir, cacheDir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        self._writeFiles(workspace, {"a.c": "#if X\nx\n#endif\ny\n"})
+        infile = os.path.join(workspace, "a.c")
+        outfile = os.path.join(outdir, "a.c")
+        for defines, expected in [({"X": 1}, "x\ny\n"), ({}, "y\n"),
+                                  ({"X": 1}, "x\ny\n")]:
+            preprocess.preprocessWorkspace(workspace, outdir, defines,
+                                           cacheDir=cacheDir)
+            self.assertEqual(open(outfile).read(), expected)
+        cache = preprocess._OutputCache(cacheDir)
+        index = preprocess._IncludeIndex(workspace)
+        for defines in ({"X": 1}, {}):
+            key = cache.key(infile, preprocess.MacroTable(defines))
+            self.assertTrue(cache.lookup(key, index) is not None)
+        # An output that doesn't change isn't rewritten.
+        os.utime(outfile, (1, 1))
+        preprocess.preprocessWorkspace(workspace, outdir, {"X": 1},
+                                       cacheDir=cacheDir)
+        self.assertEqual(os.stat(outfile).st_mtime, 1)
+
+    def test_watch(self):
+        import preprocess
+        workspace = os.path.join(self.tmpdir, "watch")
+        outdir = os.path.join(self.tmpdir, "watch_out")
+        for path in (workspace, outdir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        self._writeFiles(workspace, {
+            "a.h": "a\n",
+            "b.h": '#include "a.h"\n',
+            "c.c": '#include "b.h"\nc\n',
+            "d.c": "d\n",
+        })
+        watch = preprocess._Watch(workspace, outdir, {})
+        remade, failures = watch.update()
+        self.assertEqual(len(remade), 4)
+        # A change to a header remakes what #include's it, even indirectly.
+        aPath = os.path.join(workspace, "a.h")
+        self._writeFiles(workspace, {"a.h": "a2\n"})
+        remade, failures = watch.update([aPath])
+        self.assertEqual(sorted(os.path.basename(p) for p in remade),
+                         ["a.h", "b.h", "c.c"])
+        self.assertEqual(open(os.path.join(outdir, "c.c")).read(),
+                         'a2\n#include "a.h"\n#include "b.h"\nc\n')
+        # A new file is picked up from the change to its directory.
+        self._writeFiles(workspace, {"e.c": "e\n"})
+        remade, failures = watch.update([os.path.join(workspace, "e.c")],
+                                        [workspace])
+        self.assertEqual(remade, [os.path.join(workspace, "e.c")])
+        # Without the changes (the watcher lost track), new files are
+        # still found.
+        self._writeFiles(workspace, {"f.c": "f\n"})
+        remade, failures = watch.update()
+        self.assertEqual(remade, [os.path.join(workspace, "f.c")])
+
+    def test_stats(self):
+        import preprocess
+        from io import StringIO
+        workspace = os.path.join(self.tmpdir, "stats")
+        outdir = os.path.join(self.tmpdir, "stats_out")
+        for path in (workspace, outdir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        self._writeFiles(workspace, {
+            "g.h": "#ifndef G_H\n#define G_H\ng\n#endif\n",
+            "a.c": '#include "g.h"\n#include "g.h"\n#if X > 1\nx\n#endif\n',
+        })
+        stats = preprocess.PreprocessStats()
+        preprocess.preprocess(workspace, os.path.join(workspace, "a.c"),
+                              StringIO(), {"X": 2}, stats=stats)
+        self.assertEqual(stats.directives, {"include": 2, "if": 1,
+                                            "ifndef": 1, "define": 1,
+                                            "endif": 2})
+        self.assertEqual(stats.calls["evaluate"], 2)
+        self.assertEqual(stats.conditionCache["hits"]
+                         + stats.conditionCache["misses"], 2)
+        self.assertEqual(stats.calls["lookup"], 2)
+        included, guarded = stats.files[os.path.join(workspace, "g.h")][:2]
+        self.assertEqual((included, guarded), (2, 1))
+        fout = StringIO()
+        stats.report(fout)
+        self.assertTrue(os.path.join(workspace, "g.h") in fout.getvalue())
+        self.assertTrue("#if cache: hits" in fout.getvalue())
+        stats = preprocess.PreprocessStats()
+        preprocess.preprocessWorkspace(workspace, outdir, stats=stats)
+        self.assertEqual(stats.counters, {"made": 2, "upToDate": 0})
+        # The counts of worker processes are merged.
+        stats = preprocess.PreprocessStats()
+        preprocess.preprocessWorkspace(workspace, outdir, stats=stats, jobs=2)
+        self.assertEqual(stats.conditionCache["hits"]
+                         + stats.conditionCache["misses"], 3)
+
+    def test_trace(self):
+        import preprocess, json
+        from io import StringIO
+        workspace = os.path.join(self.tmpdir, "trace")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        self._writeFiles(workspace, {
+            "b.h": "#if 0\nno\nno\n#endif\nb\n",
+            "a.c": 'a\n#include "b.h"\n',
+        })
+        aPath = os.path.join(workspace, "a.c")
+        bPath = os.path.join(workspace, "b.h")
+        stats = preprocess.PreprocessStats(trace=True)
+        fout = StringIO()
+        preprocess.preprocess(workspace, aPath, fout, {}, stats=stats)
+        self.assertEqual(fout.getvalue(), 'a\nb\n#include "b.h"\n')
+        fout = StringIO()
+        stats.writeChromeTrace(fout)
+        events = json.loads(fout.getvalue())["traceEvents"]
+        self.assertEqual([(e["name"], e["args"]) for e in events], [
+            (bPath, {"depth": 1, "lines": 5, "outputLines": 1,
+                     "skippedLines": 2}),
+            (aPath, {"depth": 0, "lines": 2, "outputLines": 2,
+                     "skippedLines": 0}),
+        ])
+        fout = StringIO()
+        stats.writeCollapsedStacks(fout)
+        self.assertEqual([line.rsplit(" ", 1)[0]
+                          for line in fout.getvalue().splitlines()],
+                         [aPath, aPath + ";" + bPath])
+
+    def test_server(self):
+        import preprocess, socket, json, threading
+        if not hasattr(socket, "AF_UNIX"):
+            return
+        workspace = os.path.join(self.tmpdir, "server")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        self._writeFiles(workspace, {"a.h": "a\n",
+                                     "b.c": '#include "a.h"\n#if X\nx\n#endif\n',
+                                     "t.c": "#define INT_T int\nINT_T\n"})
+        socketPath = os.path.join(self.tmpdir, "server.sock")
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+        server = threading.Thread(target=preprocess.serve, args=(socketPath,))
+        server.start()
+        try:
+            for i in range(50):
+                if os.path.exists(socketPath):
+                    break
+                time.sleep(0.1)
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(socketPath)
+            fin = conn.makefile('rb')
+            requests = [{"workspace": workspace,
+                         "infile": os.path.join(workspace, "b.c"),
+                         "defines": {"X": 1}},
+                        {"workspace": workspace,
+                         "infile": os.path.join(workspace, "nope.c")},
+                        {"workspace": workspace,
+                         "infile": os.path.join(workspace, "t.c")}]
+            for request in requests:
+                conn.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            response = json.loads(fin.readline())
+            self.assertEqual(response["output"], 'a\n#include "a.h"\nx\n')
+            self.assertEqual(response["defines"]["X"], 1)
+            self.assertTrue("error" in json.loads(fin.readline()))
+            # A define that is not JSON data does not take the server down.
+            response = json.loads(fin.readline())
+            self.assertEqual(response["defines"]["INT_T"], repr(int))
+            conn.sendall(b'{"shutdown": true}\n')
+            fin.readline()
+            conn.close()
+        finally:
+            server.join(10)
+        self.assertFalse(os.path.exists(socketPath))
+        # Requests more frequent than the refresh interval don't keep the
+        # index from being refreshed.
+        refreshed = {}
+        request = {"workspace": workspace,
+                   "infile": os.path.join(workspace, "late.c")}
+        self._writeFiles(workspace, {"late.c": '#include "late.h"\n'})
+        self.assertRaises(preprocess.PreprocessError,
+                          preprocess._serveRequest, request, refreshed, 0.3)
+        self._writeFiles(workspace, {"late.h": "late\n"})
+        for i in range(10):
+            time.sleep(0.1)
+            try:
+                preprocess._serveRequest(request, refreshed, 0.3)
+            except preprocess.PreprocessError:
+                continue
+            break
+        else:
+            self.fail("late.h was never found")
+
+    def test_include_graph(self):
+        import preprocess, json
+        workspace = os.path.join(self.tmpdir, "include_graph")
+        outdir = os.path.join(self.tmpdir, "include_graph_out")
+        graphPath = os.path.join(self.tmpdir, "include_graph.jsonl")
+        for path in (workspace, outdir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        self._writeFiles(workspace, {
+            "inc/b.h": "b\n",
+            "a.c": '#if 0\n#include "no.h"\n#endif\n#include "b.h"\n',
+        })
+        aPath = os.path.join(workspace, "a.c")
+        bPath = os.path.join(workspace, "inc", "b.h")
+        expected = [{"file": aPath, "includes": [[aPath, 4, "b.h", bPath]]},
+                    {"file": bPath, "includes": []}]
+        # The graph of files that are up to date comes from the manifest.
+        for i in range(2):
+            preprocess.preprocessWorkspace(
+                workspace, outdir, includeGraphPath=graphPath,
+                manifestPath=os.path.join(outdir, ".manifest"))
+            self.assertEqual([json.loads(line) for line in open(graphPath)],
+                             expected)
+
+    def test_line_map(self):
+        import preprocess
+        from io import StringIO
+        workspace = os.path.join(self.tmpdir, "line_map")
+        outdir = os.path.join(self.tmpdir, "line_map_out")
+        for path in (workspace, outdir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        self._writeFiles(workspace, {
+            "g.h": "#ifndef G_H\n#define G_H\ng1\n#endif\n",
+            "n.h": "n1\nn2",   # no last newline
+            "a.c": 'a1\n#include "g.h"\n#if 0\nx\n#endif\n'
+                   'a6\n#include "n.h"\n#include "g.h"\na9\n',
+        })
+        aPath = os.path.join(workspace, "a.c")
+        gPath = os.path.join(workspace, "g.h")
+        nPath = os.path.join(workspace, "n.h")
+        lineMap = preprocess.LineMap()
+        fout = StringIO()
+        preprocess.preprocess(workspace, aPath, fout, lineMap=lineMap)
+        # (#define and #include lines are kept in the output.)
+        expected = [(aPath, 1), (gPath, 2), (gPath, 3), (aPath, 2),
+                    (aPath, 6), (nPath, 1), (nPath, 2), (gPath, 2),
+                    (aPath, 8), (aPath, 9)]
+        self.assertEqual(fout.getvalue().count("\n"), len(expected))
+        self.assertEqual([lineMap.lookup(i) for i in range(1, 11)],
+                         expected)
+        self.assertEqual(lineMap.lookup(11), None)
+
+        # The workspace outputs get theirs as sidecars.
+        for i in range(2):
+            preprocess.preprocessWorkspace(
+                workspace, outdir, lineMap=1,
+                manifestPath=os.path.join(outdir, ".manifest"),
+                cacheDir=os.path.join(outdir, ".cache"))
+            lineMap = preprocess.LineMap.load(
+                open(os.path.join(outdir, "a.c.linemap")))
+            self.assertEqual([lineMap.lookup(i) for i in range(1, 11)],
+                             expected)
+            os.remove(os.path.join(outdir, "a.c.linemap"))
+
+    def test_include_index_cache(self):
+        import preprocess
+        workspace = os.path.join(self.tmpdir, "include_index_cache")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        cachePath = os.path.join(self.tmpdir, "include_index_cache.idx")
+        self._writeFiles(workspace, {"inc/a.h": "a\n"})
+        if os.path.exists(cachePath):
+            os.remove(cachePath)
+        preprocess._IncludeIndex(workspace, cachePath)
+        self.assertTrue(os.path.exists(cachePath))
+        # A new file must be picked up from the reloaded index.
+        self._writeFiles(workspace, {"inc/b.h": "b\n"})
+        index = preprocess._IncludeIndex(workspace, cachePath)
+        self.assertEqual(index.resolve("b.h", index.workspace),
+                         os.path.join(index.workspace, "inc", "b.h"))
+        # refresh() only forgets the lookups that may have changed.
+        self.assertEqual(index.resolve("c.h", index.workspace), None)
+        index.resolve("a.h", index.workspace)
+        self._writeFiles(workspace, {"sub/c.h": "c\n"})
+        os.remove(os.path.join(workspace, "inc", "b.h"))
+        self.assertTrue(index.refresh())
+        self.assertTrue((index.workspace, "a.h", ()) in index._resolved)
+        self.assertEqual(index.resolve("c.h", index.workspace),
+                         os.path.join(index.workspace, "sub", "c.h"))
+        self.assertEqual(index.resolve("b.h", index.workspace), None)
+        fresh = preprocess._IncludeIndex(workspace)
+        self.assertEqual((index.dirs, index.files, index.byName),
+                         (fresh.dirs, fresh.files, fresh.byName))
+        self.assertFalse(index.refresh())
+
+    def test_include_index_links_and_case(self):
+        import preprocess
+        workspace = os.path.join(self.tmpdir, "include_index_links")
+        if os.path.exists(workspace):
+            shutil.rmtree(workspace)
+        self._writeFiles(workspace, {"real/x.h": "x\n", "src/Foo.h": "f\n"})
+        if hasattr(os, "symlink"):
+            # Symlinked dirs aren't walked, but can be #include'd through.
+            os.symlink(os.path.join(os.path.abspath(workspace), "real"),
+                       os.path.join(workspace, "src", "link"))
+            index = preprocess._IncludeIndex(workspace)
+            srcdir = os.path.join(index.workspace, "src")
+            self.assertEqual(index.resolve("link/x.h", srcdir),
+                             os.path.join(srcdir, "link", "x.h"))
+            self.assertEqual(index.resolve("link/y.h", srcdir), None)
+            self._writeFiles(workspace, {"real/y.h": "y\n"})
+            index.refresh()
+            self.assertEqual(index.resolve("link/y.h", srcdir),
+                             os.path.join(srcdir, "link", "y.h"))
+        # Where paths are case-insensitive, so are the lookups.
+        normcase = os.path.normcase
+        os.path.normcase = lambda path: path.lower()
+        try:
+            index = preprocess._IncludeIndex(workspace)
+            self.assertEqual(index.resolve("foo.h", index.workspace),
+                             os.path.join(index.workspace, "src", "foo.h"))
+        finally:
+            os.path.normcase = normcase
+
 
 
 #---- mainline